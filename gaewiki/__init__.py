@@ -14,7 +14,7 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 import handlers
 
 
-application = webapp.WSGIApplication(handlers.handlers)
+application = handlers.Application(handlers.handlers)
 
 
 def main():
@@ -1,26 +1,23 @@
 # encoding=utf-8
 
-import re
-
 import model
 import settings
-import util
 
 
 def is_page_whitelisted(title):
-    pattern = settings.get('page-whitelist')
+    pattern = settings.get_pattern('page-whitelist')
     if pattern is None:
         return False
-    return re.match(pattern, title) is not None
+    return pattern.match(title) is not None
 
 
 def is_page_blacklisted(title):
     if is_page_whitelisted(title):
         return False
-    pattern = settings.get('page-blacklist')
+    pattern = settings.get_pattern('page-blacklist')
     if pattern is None:
         return False
-    return re.match(pattern, title) is not None
+    return pattern.match(title) is not None
 
 
 def can_edit_page(title, user=None, is_admin=False):
@@ -32,7 +29,7 @@ def can_edit_page(title, user=None, is_admin=False):
 
     if '/' in title and settings.get('parents-must-exist') == 'yes':
         parent_title = '/'.join(title.split('/')[:-1])
-        parent = model.WikiContent.gql('WHERE title = :1', parent_title).get()
+        parent = model.WikiContent.get_by_title(parent_title, create_if_none=False)
         if parent is None:
             return False
 
@@ -43,7 +40,7 @@ def can_edit_page(title, user=None, is_admin=False):
         return False
     if settings.get('open-editing') == 'login':
         return not is_page_blacklisted(title)
-    if user.email() in settings.get('editors', []):
+    if user.email() in settings.get_set('editors'):
         return not is_page_blacklisted(title)
     return False
 
@@ -59,22 +56,21 @@ def can_read_page(title, user, is_admin):
     if is_admin:
         return True
 
-    is_user_reader = user and (user.email() in settings.get('readers', []) or user.email() in settings.get('editors', []))
+    is_user_reader = user and (user.email() in settings.get_set('readers') or user.email() in settings.get_set('editors'))
     if is_user_reader:
         return True
 
-    page = model.WikiContent.get_by_title(title)
-    options = util.parse_page(page.body or '')
+    private, public, readers, editors = model.WikiContent.get_access_by_title(title)
 
     is_open_wiki = settings.get('open-reading', 'yes') == 'yes'
     if is_open_wiki:
-        if options.get('private') != 'yes':
+        if not private:
             return True
-        return user and (user.email() in options.get('readers', []) or user.email() in options.get('editors', []))
+        return user and (user.email() in readers or user.email() in editors)
     elif settings.get('open-reading') == 'login':
-        return options.get('public') == 'yes' or user
+        return public or user
     else:
-        return options.get('public') == 'yes'
+        return public
 
 
 def can_see_most_pages(user, is_admin):
@@ -86,9 +82,9 @@ def can_see_most_pages(user, is_admin):
         return False
     if settings.get('open-reading') == 'login':
         return True
-    if user.email() in settings.get('readers', []):
+    if user.email() in settings.get_set('readers'):
         return True
-    if user.email() in settings.get('editors', []):
+    if user.email() in settings.get_set('editors'):
         return True
     return False
 
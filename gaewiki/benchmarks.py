@@ -0,0 +1,183 @@
+# encoding=utf-8
+
+"""Rough performance measurements, run with "make bench".  Uses the same
+in-memory testbed as the unit tests, so the numbers only make sense relative
+to each other."""
+
+import difflib
+import itertools
+import sys
+import time
+
+from django.utils import simplejson
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import testbed
+
+import diff
+import markdown
+import model
+import settings
+import util
+
+
+SAMPLE_PAGE = u"""labels: sample
+---
+# Sample page
+
+This page is used when no export file is given.  Some **bold** and _italic_
+text, a [link](http://example.com/) and a [[wiki link]].
+
+## A table
+
+| Name | Value |
+|------|-------|
+| foo  | 1     |
+| bar  | 2     |
+
+## Some code
+
+~~~
+def hello():
+    print 'Hello, world.'
+~~~
+
+Term
+:   Definition.
+
+- one
+- two
+- three
+"""
+
+
+def load_sample_pages():
+    """Returns page bodies from the export file specified on the command line
+    (see /w/data/export), or a synthetic page."""
+    if len(sys.argv) < 2:
+        return [SAMPLE_PAGE]
+    items = [simplejson.loads(line) for line in open(sys.argv[1], 'rb') if line.strip()]
+    return [item['body'] for item in items if item.get('kind') == 'page' and item['body']]
+
+
+def load_sample_pairs():
+    """Returns pairs of consecutive revisions of pages from the export file
+    specified on the command line (exported with ?revisions=yes), or a
+    synthetic 50KB page with a few dozen edited lines."""
+    if len(sys.argv) < 2:
+        lines = [u'Line %u of a long specification page, with *some* text & <markup>.\n' % idx for idx in xrange(750)]
+        old = u''.join(lines)
+        for idx in xrange(0, len(lines), 25):
+            lines[idx] = u'Edited ' + lines[idx]
+        return [(old, u''.join(lines))]
+    history = {}
+    for line in open(sys.argv[1], 'rb'):
+        if line.strip():
+            item = simplejson.loads(line)
+            if item.get('kind') == 'revision':
+                history.setdefault(item['title'], []).append((item['created'], item['body'] or u''))
+            elif item.get('kind') == 'page':
+                history.setdefault(item['title'], []).append((item['updated'], item['body'] or u''))
+    pairs = []
+    for versions in history.values():
+        versions.sort()
+        bodies = [body for created, body in versions]
+        pairs.extend(zip(bodies, bodies[1:]))
+    return pairs
+
+
+class Benchmark(object):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # High replication, so that cross-group transactions work.
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        settings.settings = None
+
+        self.rpc = util.RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('rpc_counter', self.rpc.hook)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def report(self, name, value, unit):
+        print '%-50s %10s %s' % (name, value, unit)
+
+    def measure(self, name, func, repeat=1):
+        """Runs the function, reports the time, the number of datastore calls
+        and the amount of data received from the datastore per run."""
+        self.rpc.reset()
+        started = time.time()
+        for i in xrange(repeat):
+            func()
+        elapsed = (time.time() - started) / repeat
+        self.report(name, '%.1f' % (elapsed * 1000), 'ms')
+        self.report(name, self.rpc.count('datastore_v3') / repeat, 'datastore calls')
+        self.report(name, self.rpc.bytes_received('datastore_v3') / repeat, 'datastore bytes')
+        self.report(name, self.rpc.count('memcache') / repeat, 'memcache calls')
+
+    def bench_wikify_links(self):
+        """Renders a hub page with 300 links, half of them to existing
+        pages."""
+        for idx in xrange(150):
+            model.WikiContent(title='page %u' % idx, body='# page %u' % idx).put()
+        text = u'\n'.join([u'- [[page %u]]' % idx for idx in xrange(300)])
+        settings.get_all()
+
+        self.measure('wikify, 300 links, cold', lambda: util.wikify(text))
+        self.measure('wikify, 300 links, warm', lambda: util.wikify(text))
+
+    def bench_page_lists(self):
+        """Compares building the page index from full pages and from page
+        summaries."""
+        for idx, body in enumerate(load_sample_pages()):
+            model.WikiContent(title='page %u' % idx, body=body).put()
+        settings.get_all()
+
+        self.measure('page index, full pages', lambda: model.WikiContent.all().order('title').fetch(1000))
+        self.measure('page index, summaries', lambda: model.WikiContent.get_all())
+        self.measure('recent changes, summaries', lambda: model.WikiContent.get_changes())
+
+    def bench_diff(self):
+        """Compares the character level diff used by older versions with the
+        line, then word level diff."""
+        pairs = load_sample_pairs()
+        self.report('diff, sample pairs', len(pairs), 'pairs')
+        self.report('diff, largest page', max([len(b) for a, b in pairs] or [0]), 'characters')
+
+        items = itertools.cycle(pairs)
+        self.measure('diff, characters', lambda: difflib.SequenceMatcher(None, *items.next()).get_opcodes(), repeat=len(pairs))
+
+        items = itertools.cycle(pairs)
+        self.measure('diff, lines then words', lambda: diff.get_html(*items.next()), repeat=len(pairs))
+
+    def bench_markdown(self):
+        """Compares the cost of setting up a Markdown instance with the cost
+        of converting a page."""
+        texts = [util.parse_page(body)['text'] for body in load_sample_pages()]
+        extensions = settings.get('markdown-extensions', [])
+        self.report('markdown, sample pages', len(texts), 'pages')
+
+        self.measure('markdown, new instance', lambda: markdown.Markdown(extensions=markdown.load_extensions(extensions)), repeat=50)
+
+        pages = itertools.cycle(texts)
+        self.measure('markdown, new instance + convert', lambda: markdown.markdown(pages.next(), extensions), repeat=len(texts) * 5)
+
+        pages = itertools.cycle(texts)
+        self.measure('markdown, pooled instance + convert', lambda: util.parse_markdown(pages.next()), repeat=len(texts) * 5)
+
+
+def run_benchmarks():
+    for method in sorted(dir(Benchmark)):
+        if method.startswith('bench_'):
+            bench = Benchmark()
+            bench.setUp()
+            try:
+                getattr(bench, method)()
+            finally:
+                bench.tearDown()
+
+
+if __name__ == '__main__':
+    run_benchmarks()
@@ -0,0 +1,99 @@
+# encoding=utf-8
+
+"""Generation counters for memcache keys.
+
+Cached responses are stored under keys prefixed with the current wiki
+generation and, for lists of labelled pages, with the generations of those
+labels.  Paginated lists also depend on a named generation, such as
+"lists" or "images".  Bumping a counter makes every entry that depends on
+it unreachable; stale entries are never deleted, they age out of memcache
+on their own.
+Counters are mirrored in the datastore, so that losing one from memcache
+never brings back an old generation."""
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import settings
+
+
+KEY_PREFIX = 'gaewiki:gen:'
+
+
+class CacheGeneration(db.Model):
+    """Datastore copy of a generation counter, keyed by the counter name."""
+    value = db.IntegerProperty(default=0)
+
+
+def get_label_generation_name(label):
+    return 'label:' + label
+
+
+def get_generations(names):
+    """Returns a dictionary with current values of the specified counters."""
+    values = memcache.get_multi(names, key_prefix=KEY_PREFIX)
+    missing = [name for name in names if name not in values]
+    if missing:
+        loaded = {}
+        for name, stored in zip(missing, CacheGeneration.get_by_key_name(missing)):
+            loaded[name] = stored is not None and stored.value or 0
+        memcache.add_multi(loaded, key_prefix=KEY_PREFIX)
+        values.update(loaded)
+    return values
+
+
+def get_versioned_key(key, labels=(), generations=()):
+    """Returns the memcache key to store the value under, prefixed with the
+    wiki generation, the generations of the labels it depends on and other
+    named generations (e.g. "lists")."""
+    names = ['wiki'] + list(generations) + [get_label_generation_name(label) for label in labels]
+    values = get_generations(names)
+    return ''.join(['%s=%u:' % (name, values[name]) for name in names]) + key
+
+
+def bump(names):
+    """Increments the specified counters, invalidating all dependent
+    entries."""
+    values = {}
+    for name in names:
+        value = memcache.incr(KEY_PREFIX + name)
+        if value is None:
+            get_generations([name])
+            value = memcache.incr(KEY_PREFIX + name)
+        values[name] = value
+
+    # A racing bump may have stored a higher value already.
+    stored = CacheGeneration.get_by_key_name(names)
+    updated = []
+    for name, entity in zip(names, stored):
+        if values[name] is None:
+            logging.warning('Could not increment cache generation %s.' % name)
+        elif entity is None:
+            updated.append(CacheGeneration(key_name=name, value=values[name]))
+        elif entity.value < values[name]:
+            entity.value = values[name]
+            updated.append(entity)
+    db.put(updated)
+
+
+def bump_wiki():
+    """Invalidates everything cached with get_versioned_key()."""
+    bump(['wiki'])
+
+
+def bump_labels(labels):
+    """Invalidates lists of pages with the specified labels."""
+    if labels:
+        bump([get_label_generation_name(label) for label in set(labels)])
+
+
+def check_and_flush_chrome(titles):
+    """Invalidates the rendered sidebar and footer if any of the specified
+    pages is shown in them or is the settings page (which names them).
+    Cached full pages embed the chrome, so the wiki generation is bumped
+    too."""
+    shown = set([settings.SETTINGS_PAGE_NAME, settings.get('sidebar', 'gaewiki:sidebar'), settings.get('footer', 'gaewiki:footer')])
+    if shown.intersection(titles):
+        bump(['chrome', 'wiki'])
@@ -0,0 +1,165 @@
+# encoding=utf-8
+
+"""Builds HTML diffs between page revisions.  Texts are compared by line
+first, with the patience algorithm, so the cost depends on the number of
+lines rather than characters; changed hunks are then compared by word."""
+
+import bisect
+import cgi
+import difflib
+import re
+
+
+# Tokens for the word level pass: words, runs of whitespace and single
+# punctuation characters.
+WORD_PATTERN = re.compile(r'\w+|\s+|[^\w\s]', re.UNICODE)
+
+# Hunks with more token pairs than this are not compared word by word.
+MAX_REFINE = 250000
+
+
+def get_html(a, b):
+    """Returns HTML that shows changes from a to b, to be placed in a <pre>
+    element: removed text in <del>, added text in <ins>, all escaped."""
+    a_lines = a.splitlines(True)
+    b_lines = b.splitlines(True)
+    output = []
+    for opcode, a0, a1, b0, b1 in get_opcodes(a_lines, b_lines):
+        old = u''.join(a_lines[a0:a1])
+        new = u''.join(b_lines[b0:b1])
+        if opcode == 'equal':
+            output.append(cgi.escape(old))
+        elif opcode == 'replace':
+            output.extend(diff_words(old, new))
+        else:
+            output.extend(format_change(old, new))
+    return u''.join(output)
+
+
+def diff_words(old, new):
+    """Returns HTML parts for a changed hunk, compared word by word."""
+    old_words = WORD_PATTERN.findall(old)
+    new_words = WORD_PATTERN.findall(new)
+    if len(old_words) * len(new_words) > MAX_REFINE:
+        return format_change(old, new)
+    output = []
+    matcher = difflib.SequenceMatcher(None, old_words, new_words)
+    for opcode, a0, a1, b0, b1 in matcher.get_opcodes():
+        if opcode == 'equal':
+            output.append(cgi.escape(u''.join(old_words[a0:a1])))
+        else:
+            output.extend(format_change(u''.join(old_words[a0:a1]), u''.join(new_words[b0:b1])))
+    return output
+
+
+def format_change(old, new):
+    output = []
+    if old:
+        output.append(u'<del>' + cgi.escape(old) + u'</del>')
+    if new:
+        output.append(u'<ins>' + cgi.escape(new) + u'</ins>')
+    return output
+
+
+def get_opcodes(a, b):
+    """Returns difflib style opcodes that turn sequence a into b."""
+    matches = []
+    match_ranges(a, b, 0, len(a), 0, len(b), matches)
+    opcodes = []
+    i = j = 0
+    for ai, bj in matches + [(len(a), len(b))]:
+        if i < ai and j < bj:
+            opcodes.append(('replace', i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(('delete', i, ai, j, j))
+        elif j < bj:
+            opcodes.append(('insert', i, i, j, bj))
+        i, j = ai, bj
+        if ai < len(a):
+            # Merge runs of matching items.
+            if opcodes and opcodes[-1][0] == 'equal' and opcodes[-1][2] == ai:
+                opcodes[-1] = ('equal', opcodes[-1][1], ai + 1, opcodes[-1][3], bj + 1)
+            else:
+                opcodes.append(('equal', ai, ai + 1, bj, bj + 1))
+            i, j = ai + 1, bj + 1
+    return opcodes
+
+
+def match_ranges(a, b, alo, ahi, blo, bhi, matches):
+    """Appends pairs of indexes of matching items in a[alo:ahi] and
+    b[blo:bhi] to matches, in order.  Common prefixes and suffixes match;
+    the rest is split at the longest sequence of items that occur once in
+    both ranges, and ranges without such items fall back to difflib."""
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    suffix = []
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+        suffix.append((ahi, bhi))
+
+    if alo < ahi and blo < bhi:
+        anchors = unique_lcs(a, b, alo, ahi, blo, bhi)
+        if anchors:
+            for i, j in anchors:
+                match_ranges(a, b, alo, i, blo, j, matches)
+                matches.append((i, j))
+                alo, blo = i + 1, j + 1
+            match_ranges(a, b, alo, ahi, blo, bhi, matches)
+        else:
+            matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi])
+            for i, j, size in matcher.get_matching_blocks():
+                for k in xrange(size):
+                    matches.append((alo + i + k, blo + j + k))
+
+    suffix.reverse()
+    matches.extend(suffix)
+
+
+def unique_lcs(a, b, alo, ahi, blo, bhi):
+    """Returns the longest sequence of (i, j) pairs such that a[i] == b[j]
+    occurs once in both ranges, increasing in both i and j."""
+    a_index = find_unique(a, alo, ahi)
+    b_index = find_unique(b, blo, bhi)
+    pairs = [(i, b_index[a[i]]) for i in sorted(a_index.values()) if i is not None and b_index.get(a[i]) is not None]
+
+    # Patience sorting: tails[n] is the smallest j that ends an increasing
+    # sequence of length n + 1.
+    tails = []
+    tail_pairs = []
+    previous = []
+    for k, (i, j) in enumerate(pairs):
+        pos = bisect.bisect(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tail_pairs.append(k)
+        else:
+            tails[pos] = j
+            tail_pairs[pos] = k
+        if pos:
+            previous.append(tail_pairs[pos - 1])
+        else:
+            previous.append(None)
+
+    result = []
+    if tail_pairs:
+        k = tail_pairs[-1]
+        while k is not None:
+            result.append(pairs[k])
+            k = previous[k]
+    result.reverse()
+    return result
+
+
+def find_unique(items, lo, hi):
+    """Returns a dictionary of indexes of items in the range; items that
+    occur more than once map to None."""
+    index = {}
+    for i in xrange(lo, hi):
+        if items[i] in index:
+            index[items[i]] = None
+        else:
+            index[items[i]] = i
+    return index
@@ -1,20 +1,26 @@
 # encoding=utf-8
 
 import logging
+import math
 import os
+import time
 import traceback
 import urllib
 
 from django.utils import simplejson
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import users
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import blobstore
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import blobstore_handlers
 from google.appengine.runtime.apiproxy_errors import OverQuotaError
 
 import access
+import cache
 import images
 import model
 import settings
@@ -22,6 +28,26 @@ import util
 import view
 
 
+# Paginated lists are versioned by the "lists" generation instead.
+GLOBAL_CACHE_KEYS = ['Sitemap:', 'ChangesFeed:']
+
+
+def get_page_cache_keys(titles, labels):
+    """Returns memcache keys of everything that displays the specified pages
+    or lists pages with the specified labels.  Label feeds are versioned by
+    label generations and aren't listed."""
+    titles = list(titles)
+    for label in set(labels):
+        if label.startswith('gaewiki:parent:'):
+            titles.append(label[15:])
+        else:
+            titles.append('Label:' + label)
+    keys = []
+    for title in set(titles):
+        keys.extend(['Page:' + title, 'PageBody:' + title, 'RawPage:' + title, 'PageHistory:' + title, 'BackLinks:' + title])
+    return keys
+
+
 class NotFound(Exception):
     pass
 
@@ -92,16 +118,53 @@ class RequestHandler(webapp.RequestHandler):
 
     def get_memcache(self):
         """memcache is active only anonymous user."""
-        content = None
-        user = users.get_current_user()
-        if not user:
-            content = memcache.get(self.get_memcache_key())
+        if users.get_current_user():
+            return self.get_content()
+        return self.get_cached(self.get_memcache_key(), self.get_content, self.get_memcache_labels(), self.get_memcache_generations())
+
+    def get_cached(self, key, func, labels=(), generations=()):
+        """Returns the cached value, calls func to build it on a miss."""
+        key = cache.get_versioned_key(key, labels, generations)
+        content = memcache.get(key)
         if not content:
-            content = self.get_content()
-            if not user:
-                memcache.set(self.get_memcache_key(), content)
+            content = func()
+            memcache.set(key, content)
         return content
 
+    def get_memcache_labels(self):
+        """Returns labels that the cached content depends on."""
+        return []
+
+    def get_memcache_generations(self):
+        """Returns names of other cache generations that the cached content
+        depends on, see cache.get_versioned_key()."""
+        return []
+
+    def get_cursor(self):
+        """Returns the "cursor" parameter which selects a batch of a long
+        list, None for the first batch."""
+        cursor = self.request.get('cursor')
+        if not cursor:
+            return None
+        self.check_cursor(cursor)
+        return cursor
+
+    def check_cursor(self, cursor):
+        """Raises BadRequest unless cursor is a valid datastore cursor."""
+        try:
+            datastore_query.Cursor.from_websafe_string(cursor)
+        except db.BadValueError:
+            raise BadRequest
+
+    def get_next_url(self, cursor):
+        """Returns the URL of the next batch of a list, None if there are no
+        more."""
+        if cursor is None:
+            return None
+        params = [(k, self.request.get(k).encode('utf-8')) for k in self.request.arguments() if k != 'cursor']
+        params.append(('cursor', cursor))
+        return self.request.path + '?' + urllib.urlencode(params)
+
 
 class PageHandler(RequestHandler):
     def get(self, page_name):
@@ -137,16 +200,24 @@ class PageHandler(RequestHandler):
     def get_content(self):
         page = model.WikiContent.get_by_title(self.title)
         if self.raw:
-            return model.WikiContent.parse_body(page.body or '')
+            return page.get_parsed_body()
         else:
             if self.revision:
                 revision = model.WikiRevision.get_by_key(self.request.get("r"))
                 if revision is None:
                     raise NotFound("No such revision.")
-                page.body = revision.revision_body
+                # Access checks must see the current page, not the revision.
+                model.WikiContent.forget(self.title)
+                page.body = revision.get_body()
                 page.author = revision.author
                 page.updated = revision.created
-            return view.view_page(page, user=users.get_current_user(), is_admin=users.is_current_user_admin(), revision=self.revision)
+                cached_body = None
+            else:
+                # The page body is the same for all users, only the chrome
+                # around it is personal.
+                def cached_body(render):
+                    return self.get_cached('PageBody:' + self.title, render)
+            return view.view_page(page, user=users.get_current_user(), is_admin=users.is_current_user_admin(), revision=self.revision, cached_body=cached_body)
 
 
 class StartPageHandler(PageHandler):
@@ -164,6 +235,8 @@ class EditHandler(RequestHandler):
     def edit_page(self, title, body=None, comment=None):
         page = model.WikiContent.get_by_title(title)
         if body:
+            # Access checks must see the saved page, not the preview.
+            model.WikiContent.forget(title)
             page.body = body
         user = users.get_current_user()
         is_admin = users.is_current_user_admin()
@@ -183,68 +256,238 @@ class EditHandler(RequestHandler):
         if not access.can_edit_page(title, user, users.is_current_user_admin()):
             raise Forbidden
         page = model.WikiContent.get_by_title(title)
+        existed = page.is_saved()
+        purge = {
+            'title': [page.title],
+            'label': list(page.labels),
+            'link': list(page.links),
+        }
         page.update(body=self.request.get('body'), author=user, comment=self.request.get('comment'), delete=self.request.get('delete'))
         self.redirect('/' + urllib.quote(page.title.encode('utf-8').replace(' ', '_')))
-        taskqueue.add(url="/w/cache/purge", params={})
+        if not existed or self.request.get('delete') or page.title != purge['title'][0]:
+            # Links to the page change their "missing" class, see
+            # CachePurgeHandler.
+            purge['chrome'] = 'yes'
+        purge['title'].append(page.title)
+        purge['label'].extend(page.labels)
+        purge['link'].extend(page.links)
+        taskqueue.add(url="/w/cache/purge", params=purge)
+
+
+class TaskHandler(webapp.RequestHandler):
+    """Base class of handlers that process tasks.  Their POST requests are
+    only accepted from the task queue."""
+    def is_task(self):
+        # App Engine strips this header from requests made by clients.
+        return 'X-AppEngine-QueueName' in self.request.headers
+
+
+class CachePurgeHandler(TaskHandler):
+    """Flushes cached pages.  Edits queue a purge of the keys that depend on
+    the edited page (its old and new title, labels and links).  When the page
+    was created, deleted or renamed, the "chrome" argument also flushes the
+    sidebar and footer if they link to it.  Admins can flush everything by
+    opening /w/cache/purge, which bumps the wiki cache generation."""
+    def get(self):
+        if users.is_current_user_admin():
+            cache.bump_wiki()
+            self.response.out.write("Cache purged.")
+
+    def post(self):
+        if not self.is_task():
+            return self.error(403)
+        titles = self.request.get_all("title")
+        labels = self.request.get_all("label")
+        # Pages that link here show it as missing or not, redirects show its
+        # contents, page lists show its title.
+        backlinks = model.WikiContent.find_dependent_titles(titles, labels)
+        keys = GLOBAL_CACHE_KEYS + get_page_cache_keys(titles + backlinks, labels)
+        keys.extend(['BackLinks:' + link.replace('_', ' ') for link in set(self.request.get_all("link"))])
+        memcache.delete_multi(keys, key_prefix=cache.get_versioned_key(''))
+        cache.bump(['lists'] + [cache.get_label_generation_name(label) for label in set(labels)])
+        if self.request.get('chrome'):
+            cache.check_and_flush_chrome(backlinks)
+        logging.debug(u'Purged %u cache keys for %s' % (len(keys), u', '.join(titles)))
+
+
+class TitleKeysMigrationHandler(TaskHandler):
+    """Moves pages created by older versions to title-based keys, in batches.
+    Start by opening /w/migrate/title-keys as an admin."""
+    def get(self):
+        if users.is_current_user_admin():
+            taskqueue.add(url="/w/migrate/title-keys", params={})
+            self.response.out.write("Migration started.")
+
+    def post(self):
+        if not self.is_task():
+            return self.error(403)
+        if model.WikiContent.migrate_to_title_keys():
+            taskqueue.add(url="/w/migrate/title-keys", params={})
+        else:
+            logging.info("All pages use title keys.")
+
+
+class UuidMigrationHandler(TaskHandler):
+    """Assigns uuids to pages created by older versions and copies them to
+    their revisions, in batches.  Start by opening /w/migrate/uuids as an
+    admin."""
+    def get(self):
+        if users.is_current_user_admin():
+            taskqueue.add(url="/w/migrate/uuids", params={})
+            self.response.out.write("Migration started.")
+
+    def post(self):
+        if not self.is_task():
+            return self.error(403)
+        cursor = model.WikiContent.migrate_uuids(self.request.get("cursor") or None)
+        if cursor:
+            taskqueue.add(url="/w/migrate/uuids", params={"cursor": cursor})
+        else:
+            logging.info("All pages have uuids.")
+
+
+class RevisionCompressionHandler(TaskHandler):
+    """Moves texts of revisions written by older versions to compressed
+    RevisionText entities, in batches.  Start by opening /w/migrate/revisions
+    as an admin."""
+    def get(self):
+        if users.is_current_user_admin():
+            taskqueue.add(url="/w/migrate/revisions", params={})
+            self.response.out.write("Migration started.")
+
+    def post(self):
+        if not self.is_task():
+            return self.error(403)
+        cursor = model.WikiRevision.compress_batch(self.request.get("cursor") or None)
+        if cursor:
+            taskqueue.add(url="/w/migrate/revisions", params={"cursor": cursor})
+        else:
+            logging.info("All revision texts are compressed.")
 
 
-class CachePurgeHandler(webapp.RequestHandler):
+class NicknameMigrationHandler(TaskHandler):
+    """Reserves nicknames of users created by older versions, in batches.
+    Until this completes, saving a new nickname also costs a query.  Start by
+    opening /w/migrate/nicknames as an admin."""
     def get(self):
         if users.is_current_user_admin():
-            taskqueue.add(url="/w/cache/purge", params={})
+            taskqueue.add(url="/w/migrate/nicknames", params={})
+            self.response.out.write("Migration started.")
 
     def post(self):
-        memcache.delete('Index:')
-        memcache.delete('IndexFeed:')
-        memcache.delete('Sitemap:')
-        memcache.delete('Changes:')
-        memcache.delete('ChangesFeed:')
-        for page in model.WikiContent.all():
-            memcache.delete('Page:' + page.title)
-            memcache.delete('RawPage:' + page.title)
-            memcache.delete('PageHistory:' + page.title)
-            memcache.delete('BackLinks:' + page.title)
-            for label in page.labels:
-                memcache.delete('PagesFeed:' + label)
-                memcache.delete('GeotaggedPagesFeed:' + label)
-                memcache.delete('GeotaggedPagesJson:' + label)
+        if not self.is_task():
+            return self.error(403)
+        cursor = model.NicknameReservation.reserve_batch(self.request.get("cursor") or None)
+        if cursor:
+            taskqueue.add(url="/w/migrate/nicknames", params={"cursor": cursor})
+        else:
+            logging.info("All nicknames are reserved.")
+
+
+class GeoIndexHandler(TaskHandler):
+    """Adds geohashes and marker HTML to geotagged pages saved by older
+    versions, in batches.  Start by opening /w/index/geo as an admin."""
+    def get(self):
+        if users.is_current_user_admin():
+            taskqueue.add(url="/w/index/geo", params={})
+            self.response.out.write("Geo index rebuild started.")
+
+    def post(self):
+        if not self.is_task():
+            return self.error(403)
+        cursor = model.WikiContent.index_geotagged(self.request.get("cursor") or None)
+        if cursor:
+            taskqueue.add(url="/w/index/geo", params={"cursor": cursor})
+        else:
+            logging.info("All geotagged pages are indexed.")
+
+
+class PageIndexUpdateHandler(TaskHandler):
+    """Retries updating the page indexes after an edit, when they were too
+    busy to update during the edit (see WikiContent.try_update_page_index).
+    Failures are retried by the task queue."""
+    def post(self):
+        if not self.is_task():
+            return self.error(403)
+        title = self.request.get('title')
+        if self.request.get('deleted'):
+            page = model.WikiContent(title=title)
+            deleted = True
+        else:
+            page = model.WikiContent.get_by_title(title)
+            deleted = not page.is_saved()
+        page.update_page_index(self.request.get('old_title'), self.request.get_all('old_link'), self.request.get_all('old_label'), deleted)
+
+
+class PageIndexRebuildHandler(TaskHandler):
+    """Adds existing pages to the backlink and label indexes, in batches.
+    Pages saved since the upgrade are indexed already.  Start by opening
+    /w/index/rebuild as an admin."""
+    def get(self):
+        if users.is_current_user_admin():
+            taskqueue.add(url="/w/index/rebuild", params={})
+            self.response.out.write("Index rebuild started.")
+
+    def post(self):
+        if not self.is_task():
+            return self.error(403)
+        cursor = model.WikiContent.rebuild_page_index(self.request.get("cursor") or None)
+        if cursor:
+            taskqueue.add(url="/w/index/rebuild", params={"cursor": cursor})
+        else:
+            logging.info("The page index is complete.")
 
 
 class IndexHandler(RequestHandler):
     def get(self):
         self.check_open_wiki()
+        self.cursor = self.get_cursor()
         self.reply(self.get_memcache(), 'text/html')
 
     def get_memcache_key(self):
-        return 'Index:'
+        return 'Index:' + (self.cursor or '')
+
+    def get_memcache_generations(self):
+        return ['lists']
 
     def get_content(self):
-        return view.list_pages(model.WikiContent.get_all())
+        pages, cursor = model.WikiContent.fetch_index(self.cursor)
+        return view.list_pages(pages, self.get_next_url(cursor))
 
 
 class IndexFeedHandler(RequestHandler):
     def get(self):
         self.check_open_wiki()
+        self.cursor = self.get_cursor()
         self.reply(self.get_memcache(), 'application/atom+xml')
 
     def get_memcache_key(self):
-        return 'IndexFeed:'
+        return 'IndexFeed:' + (self.cursor or '')
+
+    def get_memcache_generations(self):
+        return ['lists']
 
     def get_content(self):
-        return view.list_pages_feed(model.WikiContent.get_recently_added())
+        pages, cursor = model.WikiContent.fetch_recently_added(self.cursor)
+        return view.list_pages_feed(pages, self.get_next_url(cursor))
 
 
 class PagesFeedHandler(RequestHandler):
     def get(self):
         self.check_open_wiki()
         self.label = self.request.get('label')
+        self.cursor = self.get_cursor()
         self.reply(self.get_memcache(), 'application/atom+xml')
 
     def get_memcache_key(self):
-        return 'PagesFeed:' + self.label
+        return 'PagesFeed:' + self.label + ':' + (self.cursor or '')
+
+    def get_memcache_labels(self):
+        return [self.label]
 
     def get_content(self):
-        return view.list_pages_feed(model.WikiContent.get_recent_by_label(self.label))
+        pages, cursor = model.WikiContent.fetch_recent_by_label(self.label, self.cursor)
+        return view.list_pages_feed(pages, self.get_next_url(cursor))
 
 
 class PageHistoryHandler(RequestHandler):
@@ -252,14 +495,24 @@ class PageHistoryHandler(RequestHandler):
         self.title = self.request.get('page')
         if not access.can_read_page(self.title, users.get_current_user(), users.is_current_user_admin()):
             raise Forbidden
+        self.cursor = self.get_cursor()
         self.reply(self.get_memcache(), 'text/html')
 
     def get_memcache_key(self):
+        if self.cursor:
+            return 'PageHistory:' + self.title + ':' + self.cursor
         return 'PageHistory:' + self.title
 
+    def get_memcache_generations(self):
+        # Only the first batch is purged by title.
+        if self.cursor:
+            return ['lists']
+        return []
+
     def get_content(self):
         page = model.WikiContent.get_by_title(self.title)
-        return view.show_page_history(page, user=users.get_current_user(), is_admin=users.is_current_user_admin())
+        revisions, cursor = page.fetch_history(self.cursor)
+        return view.show_page_history(page, revisions, self.get_next_url(cursor), user=users.get_current_user(), is_admin=users.is_current_user_admin())
 
 
 class RobotsHandler(RequestHandler):
@@ -287,13 +540,18 @@ class ChangesHandler(RequestHandler):
     def get(self):
         if not access.can_see_most_pages(users.get_current_user(), users.is_current_user_admin()):
             raise Forbidden
+        self.cursor = self.get_cursor()
         self.reply(self.get_memcache(), 'text/html')
 
     def get_memcache_key(self):
-        return 'Changes:'
+        return 'Changes:' + (self.cursor or '')
+
+    def get_memcache_generations(self):
+        return ['lists']
 
     def get_content(self):
-        return view.get_change_list(model.WikiContent.get_changes())
+        pages, cursor = model.WikiContent.fetch_changes(self.cursor)
+        return view.get_change_list(pages, self.get_next_url(cursor))
 
 
 class ChangesFeedHandler(RequestHandler):
@@ -321,7 +579,7 @@ class BackLinksHandler(RequestHandler):
 
     def get_content(self):
         page = model.WikiContent.get_by_title(self.title)
-        return view.get_backlinks(page, page.get_backlinks())
+        return view.get_backlinks(page, model.WikiContent.find_backlink_titles([page.title]))
 
 
 class UsersHandler(RequestHandler):
@@ -333,35 +591,94 @@ class UsersHandler(RequestHandler):
 
 
 class DataExportHandler(RequestHandler):
+    """Exports all pages as JSON lines, one object per line.  Add
+    ?revisions=yes to include old revisions.  Big wikis are exported in
+    parts: when time runs out, the last line is {"kind": "next", "url": ...}
+    and the same URL is sent in the Link header.  Parts can be imported
+    one by one or concatenated."""
+    # Seconds to spend on one part, well within the request deadline.
+    TIME_LIMIT = 30
+
     def get(self):
         if not users.is_current_user_admin():
             raise Forbidden
-        pages = dict([(p.title, {
-            'author': p.author and p.author.wiki_user.email(),
-            'updated': p.updated.strftime('%Y-%m-%d %H:%M:%S'),
-            'body': p.body,
-        }) for p in model.WikiContent.get_all()])
-        self.reply(simplejson.dumps(pages), 'application/json', save_as='gae-wiki.json')
+        with_revisions = self.request.get('revisions') == 'yes'
+        position = self.get_position()
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.response.headers['Content-Disposition'] = 'attachment; filename="gae-wiki.jsonl"'
+        deadline = time.time() + self.TIME_LIMIT
+        for batch, position in model.WikiContent.export(with_revisions, position):
+            self.response.out.write(''.join([simplejson.dumps(item) + '\n' for item in batch]))
+            if position is not None and time.time() > deadline:
+                url = util.get_base_url() + self.request.path + '?' + urllib.urlencode({'revisions': with_revisions and 'yes' or '', 'position': position})
+                self.response.headers['Link'] = '<%s>; rel="next"' % url
+                self.response.out.write(simplejson.dumps({'kind': 'next', 'url': url}) + '\n')
+                break
+
+    def get_position(self):
+        """Returns the "position" argument, where the export resumes (see
+        model.WikiContent.export), None for the first part."""
+        position = self.request.get('position')
+        if not position:
+            return None
+        if ':' not in position:
+            raise BadRequest
+        kind, cursor = position.split(':', 1)
+        if kind not in ('page', 'revision'):
+            raise BadRequest
+        if cursor:
+            self.check_cursor(cursor)
+        return position
 
 
-class DataImportHandler(RequestHandler):
+class DataImportHandler(RequestHandler, blobstore_handlers.BlobstoreUploadHandler):
+    """Accepts an export file and starts importing it in the task queue, see
+    model.ImportJob.  Redirects to the progress report."""
     def get(self):
         if not users.is_current_user_admin():
             raise Forbidden
-        self.reply(view.get_import_form(), 'text/html')
+        self.reply(view.get_import_form(blobstore.create_upload_url(self.request.path)), 'text/html')
 
     def post(self):
         if not users.is_current_user_admin():
             raise Forbidden
-        merge = self.request.get('merge') != ''
+        uploads = self.get_uploads('file')
+        if not uploads:
+            raise BadRequest
+        blob_info = uploads[0]
+        job = model.ImportJob(blob=blob_info, size=blob_info.size, merge=self.request.get('merge') != '')
+        job.put()
+        taskqueue.add(url="/w/data/import/task", params={"job": job.key().id()})
+        return self.redirect("/w/data/import/status?job=%u" % job.key().id())
 
-        loaded = simplejson.loads(self.request.get('file'))
-        for title, content in loaded.items():
-            page = model.WikiContent.get_by_title(title)
-            author = content['author'] and users.User(content['author'])
-            page.update(content['body'], author, False)
 
-        self.reply("Done.")
+class DataImportTaskHandler(TaskHandler):
+    """Imports the next batch of an import job, then queues the rest."""
+    def post(self):
+        if not self.is_task():
+            return self.error(403)
+        job = model.ImportJob.get_by_id(int(self.request.get("job")))
+        if job is None or job.finished is not None:
+            return
+        if job.run_batch():
+            taskqueue.add(url="/w/data/import/task", params={"job": job.key().id()})
+        else:
+            logging.info(u'Imported %u pages and revisions.' % job.imported)
+            cache.bump_wiki()
+
+
+class DataImportStatusHandler(RequestHandler):
+    """Reports the progress of an import job as JSON."""
+    def get(self):
+        if not users.is_current_user_admin():
+            raise Forbidden
+        job_id = self.request.get("job")
+        if not job_id.isdigit():
+            raise BadRequest
+        job = model.ImportJob.get_by_id(int(job_id))
+        if job is None:
+            raise NotFound
+        self.reply(simplejson.dumps(job.get_status()), 'application/json')
 
 
 class InterwikiHandler(RequestHandler):
@@ -395,27 +712,67 @@ class GeotaggedPagesFeedHandler(RequestHandler):
     argument."""
     def get(self):
         self.check_open_wiki()
-        self.label = self.request.get('label', None)
+        self.label = self.request.get('label')
         self.reply(self.get_memcache(), 'application/atom+xml')
 
     def get_memcache_key(self):
         return 'GeotaggedPagesFeed:' + self.label
 
+    def get_memcache_labels(self):
+        return [self.label or model.WikiContent.GEOLABEL]
+
     def get_content(self):
         return view.list_pages_feed(model.WikiContent.find_geotagged(label=self.label))
 
 
 class GeotaggedPagesJsonHandler(RequestHandler):
+    """Returns markers for the map of geotagged pages.  The first request
+    returns recently created pages; if there are more, the map requests
+    markers of the visible area with the 'bbox' argument (south, west,
+    north, east) as it's moved.  Supports the 'label' argument."""
+    MAX_PAGES = 200
+
     def get(self):
         self.check_open_wiki()
-        self.label = self.request.get('label', None)
+        self.label = self.request.get('label')
+        self.bbox = self.get_bbox()
         self.reply(self.get_memcache(), 'text/javascript')
 
+    def get_bbox(self):
+        """Returns the requested area, rounded outwards to 0.01 degree and
+        clipped to valid coordinates, so that equivalent requests share the
+        cached response."""
+        bbox = self.request.get('bbox')
+        if not bbox:
+            return None
+        try:
+            south, west, north, east = [float(value) for value in bbox.split(',')]
+        except ValueError:
+            raise BadRequest
+        south = max(math.floor(south * 100) / 100, -90.0)
+        west = max(math.floor(west * 100) / 100, -180.0)
+        north = min(math.ceil(north * 100) / 100, 90.0)
+        east = min(math.ceil(east * 100) / 100, 180.0)
+        return south, west, north, east
+
     def get_memcache_key(self):
-        return 'GeotaggedPagesJson:' + self.label
+        bbox = ''
+        if self.bbox:
+            bbox = '%.2f,%.2f,%.2f,%.2f' % self.bbox
+        return 'GeotaggedPagesJson:' + self.label + ':' + bbox
+
+    def get_memcache_labels(self):
+        return [self.label or model.WikiContent.GEOLABEL]
 
     def get_content(self):
-        return view.show_pages_map_data(model.WikiContent.find_geotagged(label=self.label))
+        if self.bbox:
+            pages = model.WikiContent.find_geotagged_in(self.label, *self.bbox)
+            return view.show_more_map_data(pages)
+        pages = model.WikiContent.find_geotagged(label=self.label, limit=self.MAX_PAGES)
+        more_url = None
+        if len(pages) == self.MAX_PAGES:
+            more_url = self.request.path + '?' + urllib.urlencode([('label', self.label.encode('utf-8')), ('bbox', '')])
+        return view.show_pages_map_data(pages, more_url)
 
 
 class PageMapHandler(RequestHandler):
@@ -475,6 +832,7 @@ class ImageUploadHandler(RequestHandler, blobstore_handlers.BlobstoreUploadHandl
         upload_files = self.get_uploads('file')  # 'file' is file upload field in the form
         blob_info = upload_files[0]
 
+        cache.bump(['images'])
         image_page_url = "/w/image/view?key=" + str(blob_info.key())
         return self.redirect(image_page_url)
 
@@ -493,7 +851,7 @@ class ImageServeHandler(RequestHandler):
         }
 
         page_title = "Image:" + img.get_key()
-        data["pages"] = model.WikiContent.find_backlinks_for(page_title)
+        data["pages"] = model.WikiContent.find_backlink_titles([page_title])
 
         html = view.view_image(data, user=users.get_current_user(),
             is_admin=users.is_current_user_admin())
@@ -502,10 +860,19 @@ class ImageServeHandler(RequestHandler):
 
 class ImageListHandler(RequestHandler):
     def get(self):
-        lst = images.Image.find_all()
-        html = view.view_image_list(lst, users.get_current_user(),
-            users.is_current_user_admin())
-        self.reply(html, "text/html")
+        self.cursor = self.get_cursor()
+        self.reply(self.get_memcache(), "text/html")
+
+    def get_memcache_key(self):
+        return 'ImageList:' + (self.cursor or '')
+
+    def get_memcache_generations(self):
+        return ['images']
+
+    def get_content(self):
+        lst, cursor = images.Image.fetch_all(self.cursor)
+        return view.view_image_list(lst, users.get_current_user(),
+            users.is_current_user_admin(), self.get_next_url(cursor))
 
 class DiffHandler(RequestHandler):
     def get(self):
@@ -525,11 +892,30 @@ class DiffHandler(RequestHandler):
             rev1 = rev2
             rev2 = False
         if not rev2:
-            rev2 = model.WikiContent.get_by_uuid(rev1.uuid)
+            rev2 = model.WikiContent.get_by_uuid(rev1.uuid, title=rev1.title)
         html = view.view_diff(rev1, rev2, users.get_current_user(), users.is_current_user_admin())
         self.reply(html, 'text/html')
 
 
+class Application(webapp.WSGIApplication):
+    """Sets up request-scoped caches and logs the number of API calls made
+    by every request."""
+    def __init__(self, *args, **kwargs):
+        webapp.WSGIApplication.__init__(self, *args, **kwargs)
+        self.rpc_counter = util.RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('gaewiki_rpc_counter', self.rpc_counter.hook)
+
+    def __call__(self, environ, start_response):
+        settings.begin_request()
+        model.begin_request()
+        self.rpc_counter.reset()
+        try:
+            return webapp.WSGIApplication.__call__(self, environ, start_response)
+        finally:
+            model.end_request()
+            logging.info('%s %s: %u datastore calls, %u memcache calls.' % (environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), self.rpc_counter.count('datastore_v3'), self.rpc_counter.count('memcache')))
+
+
 handlers = [
     ('/', StartPageHandler),
     ('/robots\.txt$', RobotsHandler),
@@ -539,6 +925,8 @@ handlers = [
     ('/w/changes\.rss$', ChangesFeedHandler),
     ('/w/data/export$', DataExportHandler),
     ('/w/data/import$', DataImportHandler),
+    ('/w/data/import/task$', DataImportTaskHandler),
+    ('/w/data/import/status$', DataImportStatusHandler),
     ('/w/edit$', EditHandler),
     ('/w/history$', PageHistoryHandler),
     ('/w/image/upload', ImageUploadHandler),
@@ -556,6 +944,13 @@ handlers = [
     ('/w/users$', UsersHandler),
     ('/w/login', LoginHandler),
     ('/w/cache/purge$', CachePurgeHandler),
+    ('/w/migrate/title-keys$', TitleKeysMigrationHandler),
+    ('/w/migrate/uuids$', UuidMigrationHandler),
+    ('/w/migrate/revisions$', RevisionCompressionHandler),
+    ('/w/migrate/nicknames$', NicknameMigrationHandler),
+    ('/w/index/rebuild$', PageIndexRebuildHandler),
+    ('/w/index/geo$', GeoIndexHandler),
+    ('/w/index/page$', PageIndexUpdateHandler),
     ('/w/diff/$', DiffHandler),
     ('/(.+)$', PageHandler),
 ]
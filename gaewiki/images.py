@@ -1,6 +1,8 @@
 from google.appengine.api.images import get_serving_url
 from google.appengine.ext import blobstore
 
+import util
+
 
 class Image(object):
     def __init__(self, blob):
@@ -12,8 +14,14 @@ class Image(object):
 
     @classmethod
     def find_all(cls, limit=100):
-        all = blobstore.BlobInfo.all().fetch(limit)
-        return [cls(i) for i in all]
+        return cls.fetch_all(limit=limit)[0]
+
+    @classmethod
+    def fetch_all(cls, cursor=None, limit=50):
+        """Returns a batch of images, newest first, and the cursor of the
+        next batch."""
+        blobs, cursor = util.fetch_page(blobstore.BlobInfo.all().order('-creation'), cursor, limit)
+        return [cls(i) for i in blobs], cursor
 
     def get_info(self):
         """Returns a dictionary with basic image properties."""
@@ -1,19 +1,71 @@
 # encoding=utf-8
 
 import datetime
+import hashlib
 import logging
 import random
 import re
+import threading
+import zlib
 from uuid import uuid4 as uuid_generate
 
+from django.utils import simplejson
+from google.appengine.api import files
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import users
+from google.appengine.ext import blobstore
 from google.appengine.ext import db
 
+import cache
 import settings
 import util
 
 
+# Pages and users loaded during the current request, see get_request_pages()
+# and get_request_users().
+identity_map = threading.local()
+
+
+def begin_request():
+    """Starts remembering loaded pages and users, so that every one is only
+    fetched once per request."""
+    identity_map.pages = {}
+    identity_map.users = {}
+
+
+def end_request():
+    identity_map.pages = None
+    identity_map.users = None
+
+
+def get_request_pages():
+    """Returns a dictionary of pages loaded during the current request, by
+    key name (None for pages known to be missing).  Returns None outside of
+    requests handled by the application (tasks are requests too), e.g. in
+    unit tests, when nothing is remembered."""
+    return getattr(identity_map, 'pages', None)
+
+
+def get_request_users():
+    """Returns a dictionary of WikiUser entities loaded during the current
+    request, by key and by email address.  Returns None outside of
+    requests."""
+    return getattr(identity_map, 'users', None)
+
+
+def get_key_or_none(entity):
+    """Returns the key of the entity, None if it doesn't have one yet (no key
+    name and never saved)."""
+    try:
+        return entity.key()
+    except db.NotSavedError:
+        return None
+
+
 class WikiUser(db.Model):
+    """Describes a user.  Users are keyed by user id (see key_name_for);
+    users created by older versions have numeric ids."""
     wiki_user = db.UserProperty()
     joined = db.DateTimeProperty(auto_now_add=True)
     wiki_user_picture = db.BlobProperty()
@@ -21,6 +73,13 @@ class WikiUser(db.Model):
     nickname = db.StringProperty()
     public_email = db.StringProperty()
 
+    def __init__(self, *args, **kwargs):
+        super(WikiUser, self).__init__(*args, **kwargs)
+        # The nickname as stored in the datastore, see put().
+        self._saved_nickname = None
+        if kwargs.get('_from_entity'):
+            self._saved_nickname = self.nickname
+
     def get_nickname(self):
         if self.nickname:
             return self.nickname
@@ -30,33 +89,151 @@ class WikiUser(db.Model):
         return self.public_email or self.wiki_user.email()
 
     def put(self):
-        if self.nickname:
-            other = self.gql('WHERE nickname = :1', self.nickname).get()
-            if other is not None and other.key() != self.key():
+        """Saves the user.  A changed nickname is claimed in the same
+        transaction (see NicknameReservation), RuntimeError is raised if
+        another user has it."""
+        old = self._saved_nickname
+        if self.nickname and self.nickname.lower() != (old or u'').lower():
+            if NicknameReservation.is_taken_by_legacy_user(self.nickname, self):
                 raise RuntimeError('This nickname is already taken, please choose a different one.')
-        return super(WikiUser, self).put()
+            key = db.run_in_transaction_options(db.create_transaction_options(xg=True), self.__put_claiming, old)
+        else:
+            key = super(WikiUser, self).put()
+        self._saved_nickname = self.nickname
+        if self.wiki_user is not None:
+            memcache.delete('WikiUser:' + self.wiki_user.email())
+            self.remember(self, self.wiki_user.email())
+        return key
+
+    def __put_claiming(self, old):
+        keys = [NicknameReservation.key_for(self.nickname)]
+        if old:
+            keys.append(NicknameReservation.key_for(old))
+        reservations = db.get(keys)
+        if reservations[0] is not None and reservations[0].get_owner_key() != get_key_or_none(self):
+            raise RuntimeError('This nickname is already taken, please choose a different one.')
+        key = super(WikiUser, self).put()
+        NicknameReservation(key=keys[0], owner=key).put()
+        if old and reservations[1] is not None and reservations[1].get_owner_key() == key:
+            reservations[1].delete()
+        return key
+
+    @classmethod
+    def remember(cls, wiki_user, email=None):
+        """Remembers a user for the rest of the request."""
+        known = get_request_users()
+        if known is not None:
+            known[wiki_user.key()] = wiki_user
+            if email is not None:
+                known[email] = wiki_user
 
     @classmethod
     def get_all(cls):
         return cls.all().order('wiki_user').fetch(1000)
 
+    @classmethod
+    def get_emails(cls, keys):
+        """Returns a dictionary of email addresses by WikiUser key, loaded
+        with one call.  Keys may repeat or be None."""
+        keys = list(set([key for key in keys if key is not None]))
+        emails = {}
+        for key, user in zip(keys, db.get(keys)):
+            if user is not None and user.wiki_user is not None:
+                emails[key] = user.wiki_user.email()
+        return emails
+
+    @classmethod
+    def prefetch(cls, entities, name='author'):
+        """Resolves references to users in the named property of the entities
+        with one batch get, so that templates don't load them one by one.
+        Returns the entities."""
+        props = [getattr(type(entity), name) for entity in entities]
+        keys = [prop.get_value_for_datastore(entity) for prop, entity in zip(props, entities)]
+        found = get_request_users() or {}
+        missing = list(set([key for key in keys if key is not None and key not in found]))
+        if missing:
+            found = dict(found)
+            for key, wiki_user in zip(missing, db.get(missing)):
+                found[key] = wiki_user
+                if wiki_user is not None:
+                    cls.remember(wiki_user)
+        for entity, prop, key in zip(entities, props, keys):
+            if found.get(key) is not None:
+                prop.__set__(entity, found[key])
+        return entities
+
+    @classmethod
+    def get_key_for(cls, user):
+        """Returns the key of the WikiUser that describes a users.User,
+        creating one if necessary.  Keys are cached in memcache, so saving a
+        page doesn't need a query to find its author."""
+        if user is None:
+            return None
+        cache_key = 'WikiUserKey:' + user.email()
+        key = memcache.get(cache_key)
+        if key is None:
+            key = cls.get_or_create(user).key()
+            memcache.set(cache_key, key)
+        return key
+
     @classmethod
     def get_or_create(cls, user):
+        """Returns the WikiUser that describes a users.User, creating one if
+        necessary.  Users are remembered for the rest of the request and
+        cached in memcache, so rendering pages for a logged in user doesn't
+        need the datastore.  Users created by older versions are found with
+        a query."""
         if user is None:
             return None
-        wiki_user = cls.gql('WHERE wiki_user = :1', user).get()
+        email = user.email()
+        known = get_request_users()
+        if known is not None and email in known:
+            return known[email]
+        wiki_user = memcache.get('WikiUser:' + email)
         if wiki_user is None:
-            wiki_user = cls(wiki_user=user)
-            wiki_user.nickname = cls.get_unique_nickname(wiki_user)
-            wiki_user.put()
+            key_name = cls.key_name_for(user)
+            wiki_user = cls.get_by_key_name(key_name)
+            if wiki_user is None:
+                wiki_user = cls.gql('WHERE wiki_user = :1', user).get()
+            if wiki_user is None:
+                wiki_user = cls(key_name=key_name, wiki_user=user)
+                wiki_user.claim_unique_nickname()
+            memcache.set('WikiUser:' + email, wiki_user)
+        cls.remember(wiki_user, email)
         return wiki_user
 
+    @classmethod
+    def key_name_for(cls, user):
+        """Returns the key name of a user's WikiUser: based on the user id,
+        which survives email changes, or on the email address for users
+        without one (e.g. authors of imported pages)."""
+        if user.user_id():
+            return 'id:' + user.user_id()
+        return 'email:' + user.email().lower()
+
+    def claim_unique_nickname(self, attempts=3):
+        """Saves a new user with a unique nickname based on the default one.
+        Retries if another user claims the nickname first."""
+        for attempt in range(attempts):
+            self.nickname = self.get_unique_nickname(self)
+            try:
+                return self.put()
+            except RuntimeError:
+                logging.info(u'Nickname %s was taken, retrying.' % self.nickname)
+        raise RuntimeError('Could not find a unique nickname.')
+
     @classmethod
     def get_unique_nickname(cls, user):
+        """Returns a nickname based on the user's one that isn't reserved.  A
+        few candidates are checked with one get; the nickname is claimed by
+        put()."""
         nickname = user.get_nickname()
-        while cls.gql('WHERE nickname = :1', nickname).get() is not None:
-            nickname = user.get_nickname() + str(random.randrange(1111, 9999))
-        return nickname
+        candidates = [nickname] + [nickname + str(random.randrange(1111, 9999)) for idx in range(4)]
+        reservations = db.get([NicknameReservation.key_for(candidate) for candidate in candidates])
+        for candidate, reservation in zip(candidates, reservations):
+            if reservation is None and not NicknameReservation.is_taken_by_legacy_user(candidate, user):
+                return candidate
+        return nickname + uuid_generate().hex[:8]
 
 
 class WikiUserReference(db.ReferenceProperty):
@@ -72,8 +249,24 @@ class WikiUserReference(db.ReferenceProperty):
 
 
 class WikiContent(db.Model):
-    """Stores current versions of pages."""
+    """Stores current versions of pages.  Pages are keyed by their normalized
+    titles (see key_name_for), so that they can be loaded without queries.
+    Pages created by older versions have numeric ids and are moved to title
+    keys by /w/migrate/title-keys."""
     GEOLABEL = 'gaewiki:geopt'
+    # Key names longer than this (in bytes) are rejected by the datastore.
+    MAX_KEY_NAME_LENGTH = 500
+    # Revision texts are stored as deltas against a full snapshot, a new one
+    # is written after this many deltas.
+    SNAPSHOT_INTERVAL = 10
+
+    # Set to False once this process knows that no id-keyed pages are left.
+    _legacy_pages = None
+    # Set to True once this process knows that the page index is complete.
+    _page_index = None
+    # Set to True once this process knows that all geotagged pages have
+    # geohashes.
+    _geo_index = None
 
     title = db.StringProperty(required=True)
     body = db.TextProperty(required=False)
@@ -81,8 +274,16 @@ class WikiContent(db.Model):
     updated = db.DateTimeProperty(auto_now_add=True)
     created = db.DateTimeProperty(auto_now_add=True)
     pread = db.BooleanProperty()
-    # Place on the map.
+    # Access control properties copied from the page header by put(), see
+    # get_access().  None in pages that weren't saved since they were added.
+    private = db.BooleanProperty()
+    public = db.BooleanProperty()
+    readers = db.StringListProperty()
+    editors = db.StringListProperty()
+    # Place on the map and its geohash (see util.geohash) for queries by
+    # area.  The HTML shown when its marker is clicked is in PageHtml.
     geopt = db.GeoPtProperty()
+    geohash = db.StringProperty()
     # The name of the page that this one redirects to.
     redirect = db.StringProperty()
     # Labels used by this page.
@@ -93,29 +294,48 @@ class WikiContent(db.Model):
     uuid = db.StringProperty()
     # Revision comment
     comment = db.StringProperty()
+    # Key of the latest revision whose text is a full snapshot, and the number
+    # of delta revisions written since, see get_backup().
+    snapshot = db.StringProperty(indexed=False)
+    snapshot_deltas = db.IntegerProperty(default=0, indexed=False)
 
     def __init__(self, *args, **kwargs):
+        if not args and 'key' not in kwargs and 'key_name' not in kwargs and kwargs.get('title'):
+            kwargs['key_name'] = self.key_name_for(kwargs['title'])
         super(WikiContent, self).__init__(*args, **kwargs)
         self._parsed_page = None
-        if self.body and not self.uuid:
-            self.uuid = uuid_generate().hex
-            self.put()
-            for rev in self.get_history(by_title=True):
-                rev.uuid = self.uuid
-                rev.put()
+        self._parsed_body = None
+        # The body as stored in the datastore, see get_html().
+        self._saved_body = None
+        if kwargs.get('_from_entity'):
+            self._saved_body = self.body
+
+    def get_parsed_body(self):
+        """Returns the parsed page body, see parse_body().  The result is
+        reused until the body changes and is shared by all callers, so it
+        must not be modified."""
+        if self._parsed_page is None or self._parsed_body is not self.body:
+            self._parsed_page = self.parse_body(self.body or '')
+            self._parsed_body = self.body
+        return self._parsed_page
+
+    def assign_uuid(self):
+        """Gives the page a uuid unless it has one.  Returns True if it was
+        assigned."""
+        if self.uuid:
+            return False
+        self.uuid = uuid_generate().hex
+        return True
 
     def get_property(self, key, default=None):
         """Returns the value of a property."""
-        if self._parsed_page is None:
-            self._parsed_page = self.parse_body(self.body or '')
-        return self._parsed_page.get(key, default)
+        return self.get_parsed_body().get(key, default)
 
     def set_property(self, key, value):
         """Changes the value of a property."""
-        if self._parsed_page is None:
-            self._parsed_page = self.parse_body(self.body or '')
-        self._parsed_page[key] = value
-        self.body = self.format_body(self._parsed_page)
+        parsed = dict(self.get_parsed_body())
+        parsed[key] = value
+        self.body = self.format_body(parsed)
 
         user = users.get_current_user()
         if user:
@@ -125,7 +345,7 @@ class WikiContent(db.Model):
 
     def get_actual_body(self):
         """Returns the page body with updated properties "date" and "author"."""
-        body = self.parse_body(self.body or '')
+        body = dict(self.get_parsed_body())
         body['date'] = self.created.strftime('%Y-%m-%d %H:%M:%S')
         body['name'] = self.title
         return self.format_body(body)
@@ -143,12 +363,45 @@ class WikiContent(db.Model):
         property."""
         data = self.get_property('summary')
         if not data:
-            data = util.wikify_filter(self.body, display_title='')
+            data = util.wikify_filter(self.body, display_title='', props=self.get_parsed_body())
         return data
 
     def get_display_title(self):
         return self.get_property('display_title', self.title)
 
+    def get_html_hash(self):
+        """Identifies the input of the page renderer: the title, the body and
+        the enabled markdown extensions."""
+        data = repr((self.title, self.body, settings.get('markdown-extensions', [])))
+        return hashlib.sha1(data).hexdigest()
+
+    def get_html(self):
+        """Returns the rendered page body.  The result is stored in PageHtml
+        and reused until the page is saved again or a page it links to is
+        created or deleted.  Pages that list other pages by label are
+        rendered every time; pages that only have their body replaced
+        (previews, old revisions) are neither loaded nor stored."""
+        storable = self.is_saved() and self.body and self.body == self._saved_body and not util.has_dynamic_links(self.body)
+        if storable:
+            stored = PageHtml.get(PageHtml.key_for(self.key()))
+            if stored is not None and stored.html is not None and stored.html_hash == self.get_html_hash():
+                return stored.html
+
+        html = util.wikify_filter(self.body, page_name=self.title, props=self.get_parsed_body())
+        if storable:
+            try:
+                PageHtml.for_page(self, html).put()
+            except db.Timeout:
+                logging.warning(u'Could not store rendered page "%s".' % self.title)
+        return html
+
+    @classmethod
+    def drop_html_linking_to(cls, titles):
+        """Makes pages that link to the specified ones render again, so that
+        the links get the right "missing" class.  Used when pages are created
+        or deleted."""
+        db.delete([PageHtml.key_for(key) for key in cls.find_backlink_keys(titles)])
+
     def get_file(self):
         return self.get_property('file')
 
@@ -166,12 +419,51 @@ class WikiContent(db.Model):
         return self.get_property('file_length')
 
     def put(self):
-        """Adds the gaewiki:parent: labels transparently."""
+        """Adds the gaewiki:parent: labels transparently.  Returns the saved
+        page, which is a copy if the page moved to a new key (see
+        before_put)."""
+        page, state = self.before_put()
+        db.put([page, PageSummary.for_page(page)])
+        page.after_put(state)
+        return page
+
+    @classmethod
+    def put_multi(cls, pages, extra=()):
+        """Saves several pages and other entities (e.g. revisions) with one
+        datastore call.  Pages that can't be saved (see before_put) are
+        logged and skipped.  Returns the saved pages."""
+        saved = []
+        states = []
+        for page in pages:
+            try:
+                page, state = page.before_put()
+                saved.append(page)
+                states.append(state)
+            except ValueError, e:
+                logging.warning(u'Not saving page "%s": %s' % (page.title, e))
+        db.put(saved + [PageSummary.for_page(page) for page in saved] + list(extra))
+        for page, state in zip(saved, states):
+            page.after_put(state)
+        return saved
+
+    def before_put(self):
+        """Updates properties derived from the body.  Returns the entity to
+        write, which is a copy under the title key if the page has to move
+        (see __copy_to_title_key), and the state that after_put() needs.
+        Raises ValueError if the page is renamed to an existing one or if
+        the title is too long for a key name."""
+        flush_titles = [self.title]
+        was_saved = self.is_saved()
+        self.assign_uuid()
+        old_links = old_labels = []
+        if was_saved:
+            old_links, old_labels = list(self.links), list(self.labels)
         if self.body is not None:
-            options = util.parse_page(self.body)
+            options = self.get_parsed_body()
             self.redirect = options.get('redirect')
             self.pread = options.get('public') == 'yes' and options.get('private') != 'yes'
-            self.labels = options.get('labels', [])
+            self.private, self.public, self.readers, self.editors = self.parse_access(options)
+            self.labels = list(options.get('labels', []))
             if 'date' in options:
                 try:
                     self.created = datetime.datetime.strptime(options['date'], '%Y-%m-%d %H:%M:%S')
@@ -181,23 +473,69 @@ class WikiContent(db.Model):
                 if self.get_by_title(options['name'], create_if_none=False) is not None:
                     raise ValueError('A page named "%s" already exists.' % options['name'])
                 self.title = options['name']
+                flush_titles.append(self.title)
             self.__update_geopt()
+        if len(self.key_name_for(self.title).encode('utf-8')) > self.MAX_KEY_NAME_LENGTH:
+            raise ValueError('The page title is too long.')
 
-        self.links = util.extract_links(self.body)
+        self.links = util.extract_links(self.body, self.title)
+        # Redirects display the target page, so they depend on it like links.
+        if self.redirect and self.redirect not in self.links:
+            self.links.append(self.redirect)
         self.add_implicit_labels()
-        db.Model.put(self)
+        page, stale_key = self.__copy_to_title_key()
+        return page, (flush_titles, was_saved, old_links, old_labels, stale_key)
+
+    def after_put(self, state):
+        """Drops stale copies and cached data, updates indexes."""
+        flush_titles, was_saved, old_links, old_labels, stale_key = state
+        stale_keys = []
+        if stale_key is not None:
+            logging.info(u'Page "%s" moved from %s to %s' % (self.title, stale_key, self.key()))
+            stale_keys.extend([stale_key, PageHtml.key_for(stale_key)])
+        if len(flush_titles) > 1:
+            stale_keys.append(PageSummary.key_for(flush_titles[0]))
+        if stale_keys:
+            db.delete(stale_keys)
+        self._saved_body = self.body
+        if self.GEOLABEL in self.labels:
+            PageHtml.for_page(self).put()
+        self.remember(flush_titles[0], None)
+        self.remember(self.title, self)
+        memcache.delete_multi(['PageExists:' + title for title in flush_titles] + ['PageAccess:' + title for title in flush_titles])
+        self.try_update_page_index(flush_titles[0], old_links, old_labels)
+        if not was_saved or len(flush_titles) > 1:
+            self.drop_html_linking_to(flush_titles)
         settings.check_and_flush(self)
+        cache.check_and_flush_chrome(flush_titles)
+
+    def __copy_to_title_key(self):
+        """Returns the page to write under the key that matches its current
+        title: the page itself, or a copy when the page is renamed or when a
+        legacy id-keyed page is saved.  Also returns the key of the stale
+        entity that must be deleted, if any."""
+        key_name = self.key_name_for(self.title)
+        key = get_key_or_none(self)
+        if key is not None and key.name() == key_name:
+            return self, None
+        stale_key = None
+        if self.is_saved():
+            stale_key = self.key()
+        values = dict([(name, prop.get_value_for_datastore(self)) for name, prop in self.properties().items()])
+        return WikiContent(key_name=key_name, **values), stale_key
 
     def __update_geopt(self):
-        """Updates the geopt property from the appropriate page property.
-        Maintains the gaewiki:geopt label."""
+        """Updates the geopt and geohash properties from the appropriate page
+        property.  Maintains the gaewiki:geopt label."""
         if self.GEOLABEL in self.labels:
             self.labels.remove(self.GEOLABEL)
 
+        self.geohash = None
         tmp = self.get_property('geo')
         if tmp is not None:
             parts = tmp.split(',', 1)
             self.geopt = db.GeoPt(float(parts[0]), float(parts[1]))
+            self.geohash = util.geohash(self.geopt.lat, self.geopt.lon)
             self.labels.append(self.GEOLABEL)
             logging.debug(u'Put %s on the map: %s' % (self.title, self.geopt))
 
@@ -214,34 +552,83 @@ class WikiContent(db.Model):
 
     def backup(self):
         """Archives the current page revision."""
+        db.put(self.get_backup() + [self])
+
+    def get_backup(self):
+        """Returns unsaved entities that archive the current page contents in
+        the page's entity group: a revision and its text, which is a delta
+        against the latest snapshot unless SNAPSHOT_INTERVAL deltas were
+        written since.  Updates the page's snapshot properties, which must be
+        saved along with the entities."""
         logging.debug(u'Backing up page "%s"' % self.title)
-        archive = WikiRevision(title=self.title, revision_body=self.body, author=self.author, created=self.updated, uuid=self.uuid, comment=self.comment)
-        archive.put()
+        revision = WikiRevision(parent=self.key(), key_name=uuid_generate().hex, title=self.title, author=WikiContent.author.get_value_for_datastore(self), created=self.updated, uuid=self.uuid, comment=self.comment)
+        base_text = None
+        if self.snapshot and self.snapshot_deltas < self.SNAPSHOT_INTERVAL:
+            base_text = RevisionText.load_snapshots([self.snapshot]).get(self.snapshot)
+        text = RevisionText.build(revision.key(), self.body or u'', self.snapshot, base_text)
+        if text.base is None:
+            self.snapshot = str(revision.key())
+            self.snapshot_deltas = 0
+        else:
+            self.snapshot_deltas = (self.snapshot_deltas or 0) + 1
+        return [revision, text]
 
     def update(self, body, author, comment, delete):
+        backup = []
+        self.assign_uuid()
         if self.is_saved():
-            self.backup()
+            backup = self.get_backup()
             if delete:
                 logging.debug(u'Deleting page "%s"' % self.title)
-                self.delete()
+                db.run_in_transaction_options(db.create_transaction_options(xg=True), self.__delete, backup)
+                self.remember(self.title, None)
+                memcache.delete_multi(['PageExists:' + self.title, 'PageAccess:' + self.title])
+                self.try_update_page_index(self.title, self.links, self.labels, deleted=True)
+                self.drop_html_linking_to([self.title])
+                settings.check_and_flush(self)
+                cache.check_and_flush_chrome([self.title])
                 return
 
         logging.debug(u'Updating page "%s"' % self.title)
 
         self.body = body
-        self.author = WikiUser.get_or_create(author)
+        self.author = WikiUser.get_key_for(author)
         self.updated = datetime.datetime.now()
         self.comment = comment
 
         # TODO: cross-link
 
-        self.put()
+        return self.save(backup)
+
+    def save(self, backup=()):
+        """Saves the page, its summary and the backup of the previous
+        revision (see get_backup), if any, with one put in a transaction.  The
+        backup is in the page's entity group; the summary (and the page
+        itself, if it's renamed) are not, so the transaction is cross-group.
+        Returns the saved page, see put()."""
+        page, state = self.before_put()
+        entities = [page, PageSummary.for_page(page)] + list(backup)
+        db.run_in_transaction_options(db.create_transaction_options(xg=True), db.put, entities)
+        page.after_put(state)
+        return page
+
+    def __delete(self, backup):
+        db.put(backup)
+        db.delete([self.key(), PageSummary.key_for(self.title), PageHtml.key_for(self.key())])
 
     def get_history(self, by_title=False):
-        if by_title:
-            return WikiRevision.gql('WHERE title = :1 ORDER BY created DESC', self.title).fetch(100)
+        return self.fetch_history(limit=100, by_title=by_title)[0]
+
+    def fetch_history(self, cursor=None, limit=50, by_title=False):
+        """Returns a batch of old revisions, newest first, and the cursor of
+        the next batch.  Revisions don't contain texts (see RevisionText), so
+        the cost doesn't depend on the size of the page."""
+        query = WikiRevision.all()
+        if by_title or not self.uuid:
+            query.filter('title =', self.title)
         else:
-            return WikiRevision.gql('WHERE uuid = :1 ORDER BY created DESC', self.uuid).fetch(100)
+            query.filter('uuid =', self.uuid)
+        return util.fetch_page(query.order('-created'), cursor, limit)
 
     def get_backlinks(self):
         return self.find_backlinks_for(self.title)
@@ -250,6 +637,206 @@ class WikiContent(db.Model):
     def find_backlinks_for(cls, title, limit=1000):
         return WikiContent.gql('WHERE links = :1', title).fetch(limit)
 
+    @classmethod
+    def find_backlink_keys(cls, titles):
+        """Returns keys of pages that link to any of the specified ones,
+        whether the links are written with spaces or underscores."""
+        variants = set()
+        for title in titles:
+            variants.add(title)
+            variants.add(title.replace(' ', '_'))
+        keys = set()
+        for variant in variants:
+            keys.update(cls.all(keys_only=True).filter('links =', variant).fetch(1000))
+        return list(keys)
+
+    @classmethod
+    def get_titles_for_keys(cls, keys):
+        """Returns page titles for a list of keys.  Title keys are decoded
+        directly, legacy pages are loaded."""
+        titles = []
+        legacy = []
+        for key in keys:
+            if key.name() is not None:
+                titles.append(key.name()[len(cls.key_name_for('')):])
+            else:
+                legacy.append(key)
+        if legacy:
+            titles.extend([p.title for p in db.get(legacy) if p is not None])
+        return titles
+
+    @classmethod
+    def find_dependent_titles(cls, titles, labels):
+        """Returns titles of pages whose rendered form depends on the
+        specified pages or labels: pages that link or redirect to the pages
+        and pages that list the labels (see util.extract_links)."""
+        targets = list(titles)
+        for label in set(labels):
+            if label.startswith('gaewiki:parent:'):
+                targets.append('ListChildren:' + label[15:])
+            else:
+                targets.append('List:' + label)
+        return cls.find_backlink_titles(targets)
+
+    @classmethod
+    def find_backlink_titles(cls, titles):
+        """Returns titles of pages that link to any of the specified ones,
+        using the page index when it's complete."""
+        if not cls.has_page_index():
+            return cls.get_titles_for_keys(cls.find_backlink_keys(titles))
+        result = set()
+        for index in BackLinks.get_by_key_name([BackLinks.key_name_for(title) for title in titles]):
+            if index is not None:
+                result.update(index.titles)
+        return sorted(result, key=lambda t: t.lower())
+
+    def get_label_entry(self):
+        """Describes the page in label listings, see LabelIndex."""
+        return (self.title, self.get_property('display_title', self.title), self.redirect or u'', self.created)
+
+    @classmethod
+    def get_label_entries(cls, label):
+        """Returns (title, display_title, redirect, created) tuples for pages
+        that have the specified label."""
+        if not cls.has_page_index():
+            return [page.get_label_entry() for page in cls.get_by_label(label)]
+        index = LabelIndex.get_by_key_name(LabelIndex.key_name_for(label))
+        if index is None:
+            return []
+        return index.get_entries()
+
+    def try_update_page_index(self, old_title, old_links, old_labels, deleted=False):
+        """Updates the page indexes (see update_page_index).  The page is
+        saved already, so if an index is too busy the update is retried in
+        the task queue (see PageIndexUpdateHandler) instead of failing the
+        request.  Pages that add or remove many links are indexed in the task
+        queue right away."""
+        if len(self.get_backlink_changes(old_title, old_links, deleted)) > BackLinks.MAX_SYNC_UPDATES:
+            self.__queue_page_index_update(old_title, old_links, old_labels, deleted)
+            return
+        try:
+            self.update_page_index(old_title, old_links, old_labels, deleted)
+        except (db.TransactionFailedError, db.Timeout), e:
+            logging.warning(u'Could not index page "%s", queued a retry: %s' % (self.title, e))
+            self.__queue_page_index_update(old_title, old_links, old_labels, deleted)
+
+    def __queue_page_index_update(self, old_title, old_links, old_labels, deleted):
+        taskqueue.add(url='/w/index/page', params={
+            'title': self.title.encode('utf-8'),
+            'old_title': old_title.encode('utf-8'),
+            'old_link': [link.encode('utf-8') for link in old_links],
+            'old_label': [label.encode('utf-8') for label in old_labels],
+            'deleted': deleted and 'yes' or '',
+        })
+
+    def update_page_index(self, old_title, old_links, old_labels, deleted=False):
+        """Updates the backlink and label indexes after the page was saved or
+        deleted.  Indexes are loaded with one get per kind, only entries that
+        changed are written, each in its own transaction.  The result only
+        depends on the current page, so this can be repeated."""
+        BackLinks.update_all(self.get_backlink_changes(old_title, old_links, deleted))
+
+        renamed = old_title != self.title
+        new_labels = []
+        if not deleted:
+            new_labels = self.labels
+        # Label entries include the display title, so they are checked even
+        # if the label didn't change.
+        entry = self.get_label_entry()
+        changes = {}
+        for label in set(old_labels) | set(new_labels):
+            add, remove = [], []
+            if label in new_labels:
+                add.append(entry)
+            if label in old_labels and (renamed or label not in new_labels):
+                remove.append(old_title)
+            changes[label] = (add, remove)
+        LabelIndex.update_all(changes)
+
+    def get_backlink_changes(self, old_title, old_links, deleted=False):
+        """Returns (add, remove) tuples of linking titles by link target, for
+        the targets whose backlinks change when the page is saved (or
+        deleted) with links that used to be old_links."""
+        renamed = old_title != self.title
+        old_links = set([link.replace('_', ' ') for link in old_links])
+        new_links = set()
+        if not deleted:
+            new_links = set([link.replace('_', ' ') for link in self.links])
+        changes = {}
+        for target in old_links | new_links:
+            if renamed or (target in old_links) != (target in new_links):
+                add, remove = [], []
+                if target in new_links:
+                    add.append(self.title)
+                if target in old_links:
+                    remove.append(old_title)
+                changes[target] = (add, remove)
+        return changes
+
+    @classmethod
+    def has_page_index(cls):
+        """Returns True if the backlink and label indexes and page summaries
+        cover all pages.  Wikis created by older versions build them with
+        /w/index/rebuild, until then listings use queries."""
+        if cls._page_index:
+            return True
+        ready = memcache.get('gaewiki:page-index')
+        if ready is None:
+            ready = PageIndexStatus.get_by_key_name('status') is not None
+            if not ready and cls.all(keys_only=True).get() is None:
+                PageIndexStatus(key_name='status').put()
+                ready = True
+            memcache.set('gaewiki:page-index', ready)
+        if ready:
+            cls._page_index = True
+        return ready
+
+    @classmethod
+    def rebuild_page_index(cls, cursor=None, limit=50):
+        """Adds a batch of pages to the backlink and label indexes and stores
+        their summaries.  Returns the cursor for the next batch, None when all
+        pages are indexed."""
+        query = cls.all()
+        if cursor:
+            query.with_cursor(cursor)
+        pages = query.fetch(limit)
+        db.put([PageSummary.for_page(page) for page in pages])
+
+        links = {}
+        labels = {}
+        for page in pages:
+            for link in set([link.replace('_', ' ') for link in page.links]):
+                links.setdefault(link, []).append(page.title)
+            entry = page.get_label_entry()
+            for label in set(page.labels):
+                labels.setdefault(label, []).append(entry)
+        for target, titles in links.items():
+            BackLinks.update(target, titles, [])
+        for label, entries in labels.items():
+            LabelIndex.update(label, entries, [])
+
+        if len(pages) < limit:
+            PageIndexStatus(key_name='status').put()
+            memcache.set('gaewiki:page-index', True)
+            return None
+        return query.cursor()
+
+    @classmethod
+    def migrate_uuids(cls, cursor=None, limit=20):
+        """Assigns uuids to a batch of pages that have none and copies page
+        uuids to revisions with the same title that have none.  Returns the
+        cursor of the next batch, None when all pages were processed."""
+        pages, cursor = util.fetch_page(cls.all().order('__key__'), cursor, limit)
+        db.put([page for page in pages if page.assign_uuid()])
+        for page in pages:
+            revisions = WikiRevision.all().filter('title =', page.title).filter('uuid =', None).fetch(1000)
+            for revision in revisions:
+                revision.uuid = page.uuid
+            if revisions:
+                logging.info(u'Assigned uuid %s to %u revisions of page "%s".' % (page.uuid, len(revisions), page.title))
+                db.put(revisions)
+        return cursor
+
     def load_template(self, user, is_admin):
         template = '# PAGE_TITLE\n\n**PAGE_TITLE** is ...'
         template_names = ['gaewiki:anon page template']
@@ -258,7 +845,7 @@ class WikiContent(db.Model):
         if users.is_current_user_admin():
             template_names.insert(0, 'gaewiki:admin page template')
         for template_name in template_names:
-            page = WikiContent.gql('WHERE title = :1', template_name).get()
+            page = WikiContent.get_by_title(template_name, create_if_none=False)
             if page is not None:
                 logging.debug('Loaded template from %s' % template_name)
                 template = page.body.replace(template_name, 'PAGE_TITLE')
@@ -284,7 +871,15 @@ class WikiContent(db.Model):
         """Finds and loads the page by its title, creates a new one if nothing
         could be found."""
         title = title.replace('_', ' ')
-        page = cls.gql('WHERE title = :1', title).get()
+        pages = get_request_pages()
+        key_name = cls.key_name_for(title)
+        if pages is not None and key_name in pages:
+            page = pages[key_name]
+        else:
+            page = cls.get_by_key_name(key_name)
+            if page is None and cls.has_legacy_pages():
+                page = cls.gql('WHERE title = :1', title).get()
+            cls.remember(title, page)
         if page is None and create_if_none:
             page = cls(title=title)
             if default_body is not None:
@@ -292,63 +887,391 @@ class WikiContent(db.Model):
         return page
 
     @classmethod
-    def get_by_uuid(cls, uuid):
-        """Finds and loads the page by its uuid."""
+    def find_existing_titles(cls, titles):
+        """Returns the set of titles (out of the specified ones) that have
+        saved pages.  Answers are cached in memcache, misses are resolved with
+        one batch get by key."""
+        titles = list(set([title.replace('_', ' ') for title in titles]))
+        cached = {}
+        pages = get_request_pages()
+        if pages is not None:
+            for title in titles:
+                key_name = cls.key_name_for(title)
+                if key_name in pages:
+                    cached[title] = pages[key_name] is not None
+            titles = [title for title in titles if title not in cached]
+        if titles:
+            cached.update(memcache.get_multi(titles, key_prefix='PageExists:'))
+        existing = set([title for title, flag in cached.items() if flag])
+
+        missing = dict([(title, False) for title in titles if title not in cached])
+        if missing:
+            lookup = missing.keys()
+            pages = db.get([cls.key_for_title(title) for title in lookup])
+            for title, page in zip(lookup, pages):
+                missing[title] = page is not None
+                cls.remember(title, page)
+            if cls.has_legacy_pages():
+                lookup = [title for title in lookup if not missing[title]]
+                for offset in xrange(0, len(lookup), 30):
+                    for page in cls.gql('WHERE title IN :1', lookup[offset:offset + 30]).fetch(1000):
+                        missing[page.title] = True
+            memcache.set_multi(missing, key_prefix='PageExists:')
+            existing.update([title for title, flag in missing.items() if flag])
+
+        return existing
+
+    @classmethod
+    def get_by_uuid(cls, uuid, title=None):
+        """Finds and loads the page by its uuid.  If the title is known (e.g.
+        from a revision), the page is looked up by key first; the query is
+        only needed if the page was renamed since."""
+        if title is not None:
+            page = cls.get_by_title(title, create_if_none=False)
+            if page is not None and page.uuid == uuid:
+                return page
         page = cls.gql('WHERE uuid = :1', uuid).get()
         return page
 
+    def get_access(self):
+        """Returns a (private, public, readers, editors) tuple describing who
+        can read the page.  Pages saved by older versions have no stored
+        access properties, their header is parsed instead."""
+        if self.private is None:
+            return self.parse_access(self.get_parsed_body())
+        return (self.private, self.public, self.readers, self.editors)
+
+    @staticmethod
+    def parse_access(options):
+        """Extracts access control properties from a parsed page body."""
+        return (options.get('private') == 'yes', options.get('public') == 'yes', options.get('readers', []), options.get('editors', []))
+
+    @classmethod
+    def get_access_by_title(cls, title):
+        """Returns access control properties of a page, see get_access().
+        They are cached in memcache until the page is saved, so that checking
+        access to a cached page doesn't require loading it."""
+        title = title.replace('_', ' ')
+        pages = get_request_pages()
+        key_name = cls.key_name_for(title)
+        if pages is not None and pages.get(key_name) is not None:
+            return pages[key_name].get_access()
+        access = memcache.get('PageAccess:' + title)
+        if access is None:
+            access = cls.get_by_title(title).get_access()
+            memcache.set('PageAccess:' + title, access)
+        return access
+
+    @classmethod
+    def remember(cls, title, page):
+        """Adds a page (or None for a missing one) to the request's identity
+        map."""
+        pages = get_request_pages()
+        if pages is not None:
+            pages[cls.key_name_for(title)] = page
+
+    @classmethod
+    def forget(cls, title):
+        """Removes a page from the request's identity map, so that changes
+        made to the loaded copy (e.g. a preview) aren't seen by later
+        lookups, which load the page again."""
+        pages = get_request_pages()
+        if pages is not None:
+            pages.pop(cls.key_name_for(title), None)
+
+    @staticmethod
+    def key_name_for(title):
+        """Returns the key name for a page with the specified title."""
+        return u'title:' + title.replace('_', ' ')
+
+    @classmethod
+    def key_for_title(cls, title):
+        return db.Key.from_path(cls.kind(), cls.key_name_for(title))
+
+    @classmethod
+    def has_legacy_pages(cls):
+        """Returns True if some pages are still stored under numeric ids and
+        can only be found with queries.  Numeric ids sort before key names,
+        so one keys-only query is enough to tell."""
+        if cls._legacy_pages is False:
+            return False
+        found = memcache.get('gaewiki:legacy-pages')
+        if found is None:
+            key = cls.all(keys_only=True).order('__key__').get()
+            found = key is not None and key.name() is None
+            memcache.set('gaewiki:legacy-pages', found)
+        if not found:
+            cls._legacy_pages = False
+        return found
+
+    @classmethod
+    def migrate_to_title_keys(cls, limit=50):
+        """Moves up to limit id-keyed pages to title keys.  If several pages
+        share a title, the most recently updated one wins.  Returns the number
+        of processed pages, zero when the migration is complete."""
+        pages = [p for p in cls.all().order('__key__').fetch(limit) if p.key().name() is None]
+        if not pages:
+            memcache.delete('gaewiki:legacy-pages')
+            return 0
+
+        keyed = {}
+        for page in pages:
+            key_name = cls.key_name_for(page.title)
+            if key_name not in keyed or page.updated > keyed[key_name].updated:
+                keyed[key_name] = page
+        for key_name, current in zip(keyed.keys(), cls.get_by_key_name(keyed.keys())):
+            if current is not None and current.updated > keyed[key_name].updated:
+                del keyed[key_name]
+        for page in pages:
+            if keyed.get(cls.key_name_for(page.title)) is page:
+                logging.info(u'Moving page "%s" to a title key.' % page.title)
+            else:
+                logging.warning(u'Dropping a stale copy of page "%s" (%s).' % (page.title, page.key()))
+
+        copies = []
+        for key_name, page in keyed.items():
+            values = dict([(name, prop.get_value_for_datastore(page)) for name, prop in page.properties().items()])
+            copies.append(cls(key_name=key_name, **values))
+        db.put(copies)
+        db.delete([p.key() for p in pages])
+        return len(pages)
+
+    @classmethod
+    def export(cls, with_revisions=False, position=None, batch_size=100):
+        """Yields lists of dictionaries describing pages and, optionally, old
+        revisions, one batch at a time (see DataExportHandler), each with the
+        position to resume from after it, None after the last one.  Authors
+        are loaded in bulk for every batch."""
+        kind, cursor = 'page', None
+        if position:
+            kind, cursor = position.split(':', 1)
+        while kind == 'page':
+            pages, cursor = util.fetch_page(cls.all().order('__key__'), cursor, batch_size)
+            if cursor is None:
+                kind = with_revisions and 'revision' or None
+            yield cls.export_pages(pages), cls.__export_position(kind, cursor)
+        while kind == 'revision':
+            revisions, cursor = util.fetch_page(WikiRevision.all().order('__key__'), cursor, batch_size)
+            if cursor is None:
+                kind = None
+            yield cls.export_revisions(revisions), cls.__export_position(kind, cursor)
+
+    @classmethod
+    def __export_position(cls, kind, cursor):
+        if kind is None:
+            return None
+        return kind + ':' + (cursor or '')
+
+    @classmethod
+    def export_pages(cls, pages):
+        author_keys = [cls.author.get_value_for_datastore(p) for p in pages]
+        emails = WikiUser.get_emails(author_keys)
+        return [{
+            'kind': 'page',
+            'title': page.title,
+            'author': emails.get(author_key),
+            'created': page.created.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated': page.updated.strftime('%Y-%m-%d %H:%M:%S'),
+            'body': page.body,
+        } for page, author_key in zip(pages, author_keys)]
+
+    @classmethod
+    def export_revisions(cls, revisions):
+        author_keys = [WikiRevision.author.get_value_for_datastore(r) for r in revisions]
+        emails = WikiUser.get_emails(author_keys)
+        bodies = WikiRevision.get_bodies(revisions)
+        return [{
+            'kind': 'revision',
+            'title': rev.title,
+            'uuid': rev.uuid,
+            'author': emails.get(author_key),
+            'created': rev.created.strftime('%Y-%m-%d %H:%M:%S'),
+            'comment': rev.comment,
+            'body': body,
+        } for rev, author_key, body in zip(revisions, author_keys, bodies)]
+
+    @classmethod
+    def import_pages(cls, items, merge=False, authors=None):
+        """Saves pages described by export items (see export()) with one
+        batch put, backing up existing ones.  With merge, existing pages are
+        skipped.  authors caches WikiUser entities by email between calls.
+        Returns the number of saved pages."""
+        if authors is None:
+            authors = {}
+        items = dict([(item['title'].replace('_', ' '), item) for item in items])
+        titles = items.keys()
+        existing = cls.get_by_key_name([cls.key_name_for(title) for title in titles])
+        if cls.has_legacy_pages():
+            existing = [page or cls.get_by_title(title, create_if_none=False) for title, page in zip(titles, existing)]
+
+        pages = []
+        revisions = []
+        for title, page in zip(titles, existing):
+            if page is None:
+                page = cls(title=title)
+            elif merge:
+                continue
+            else:
+                revisions.extend(page.get_backup())
+            email = items[title].get('author')
+            if email and email not in authors:
+                authors[email] = WikiUser.get_or_create(users.User(email))
+            page.body = items[title]['body']
+            page.author = authors.get(email)
+            page.updated = datetime.datetime.now()
+            page.comment = None
+            pages.append(page)
+        return len(cls.put_multi(pages, revisions))
+
+    @classmethod
+    def import_revisions(cls, items, merge=False, authors=None):
+        """Saves old revisions described by export items as snapshots in the
+        entity groups of their pages, in the history of current pages.  Key
+        names are derived from the contents, so importing a file twice
+        doesn't duplicate history; with merge, existing revisions are kept.
+        Returns the number of saved revisions."""
+        if authors is None:
+            authors = {}
+        items = [item for item in items if item.get('body') is not None]
+        titles = list(set([item['title'].replace('_', ' ') for item in items]))
+        existing = cls.get_by_key_name([cls.key_name_for(title) for title in titles])
+        if cls.has_legacy_pages():
+            existing = [page or cls.get_by_title(title, create_if_none=False) for title, page in zip(titles, existing)]
+        pages = dict(zip(titles, existing))
+
+        revisions = []
+        bodies = {}
+        for item in items:
+            title = item['title'].replace('_', ' ')
+            page = pages[title]
+            if page is not None:
+                parent, uuid = page.key(), page.uuid
+            else:
+                parent, uuid = cls.key_for_title(title), item.get('uuid')
+            created = datetime.datetime.now()
+            if item.get('created'):
+                created = datetime.datetime.strptime(item['created'], '%Y-%m-%d %H:%M:%S')
+            email = item.get('author')
+            if email and email not in authors:
+                authors[email] = WikiUser.get_or_create(users.User(email))
+            key_name = 'import-' + hashlib.md5((u'%s\n%s' % (item.get('created') or u'', item['body'])).encode('utf-8')).hexdigest()
+            revision = WikiRevision(parent=parent, key_name=key_name, title=title, wiki_page=parent, author=authors.get(email), created=created, uuid=uuid, comment=item.get('comment'))
+            revisions.append(revision)
+            bodies[revision.key()] = item['body']
+
+        if merge:
+            current = db.get([r.key() for r in revisions])
+            revisions = [r for r, c in zip(revisions, current) if c is None]
+        entities = []
+        for revision in revisions:
+            entities.extend([revision, RevisionText.build(revision.key(), bodies[revision.key()])])
+        db.put(entities)
+        return len(revisions)
+
     @classmethod
     def get_by_label(cls, label):
         """Returns a list of pages that have the specified label."""
         return cls.gql('WHERE labels = :1', label).fetch(100)
 
+    @classmethod
+    def get_list_kind(cls):
+        """Returns the kind that page lists query: PageSummary, which has no
+        bodies, once all pages have summaries."""
+        if cls.has_page_index():
+            return PageSummary
+        return cls
+
     @classmethod
     def get_publicly_readable(cls):
+        kind = cls.get_list_kind()
         if settings.get('open-reading') == 'yes':
-            pages = cls.all()
+            pages = kind.all()
         else:
-            pages = cls.gql('WHERE pread = :1', True).fetch(1000)
+            pages = kind.gql('WHERE pread = :1', True).fetch(1000)
         return sorted(pages, key=lambda p: p.title.lower())
 
     @classmethod
     def get_all(cls):
-        return sorted(cls.all().order('title').fetch(1000), key=lambda p: p.title.lower() if ':' in p.title else ':' + p.title.lower())
+        """Returns summaries of all pages, sorted for the index."""
+        return cls.fetch_index(limit=1000)[0]
+
+    @classmethod
+    def fetch_index(cls, cursor=None, limit=200):
+        """Returns a batch of page summaries in index order (see
+        PageSummary.get_sort_key) and the cursor of the next batch.  Until
+        the page index is built, pages are fetched in title order and only
+        sorted within the batch."""
+        kind = cls.get_list_kind()
+        if kind is PageSummary:
+            return util.fetch_page(kind.all().order('sort_key'), cursor, limit)
+        pages, cursor = util.fetch_page(kind.all().order('title'), cursor, limit)
+        return sorted(pages, key=lambda p: PageSummary.get_sort_key(p.title)), cursor
 
     @classmethod
     def get_recently_added(cls, limit=100):
-        return cls.all().order('-created').fetch(limit)
+        return cls.fetch_recently_added(limit=limit)[0]
+
+    @classmethod
+    def fetch_recently_added(cls, cursor=None, limit=50):
+        return util.fetch_page(cls.all().order('-created'), cursor, limit)
 
     @classmethod
     def get_recent_by_label(cls, label, limit=100):
-        return cls.gql('WHERE labels = :1 ORDER BY created DESC', label).fetch(limit)
+        return cls.fetch_recent_by_label(label, limit=limit)[0]
+
+    @classmethod
+    def fetch_recent_by_label(cls, label, cursor=None, limit=50):
+        return util.fetch_page(cls.gql('WHERE labels = :1 ORDER BY created DESC', label), cursor, limit)
 
     @classmethod
     def get_changes(cls):
+        return cls.fetch_changes(limit=20)[0]
+
+    @classmethod
+    def fetch_changes(cls, cursor=None, limit=50):
+        """Returns a batch of recently changed pages that the current user can
+        see, and the cursor of the next batch."""
+        kind = cls.get_list_kind()
         if settings.get('open-reading') in ('yes', 'login'):
-            pages = cls.all().order('-updated').fetch(20)
+            query = kind.all().order('-updated')
         else:
-            pages = cls.gql('WHERE pread = :1 ORDER BY updated DESC', True).fetch(20)
-        return pages
+            query = kind.gql('WHERE pread = :1 ORDER BY updated DESC', True)
+        return util.fetch_page(query, cursor, limit)
 
     @classmethod
     def get_error_page(cls, error_code, default_body=None):
         return cls.get_by_title('gaewiki:error-%u' % error_code, default_body)
 
     @staticmethod
-    def parse_body(page_content):
+    def find_header_end(page_content):
+        """Returns the position of the "---" line which separates the header
+        from the page text, or -1 if there's no header."""
+        pos = page_content.find('---')
+        while pos != -1:
+            if pos > 0 and page_content[pos - 1] in '\r\n' and page_content[pos + 3:pos + 4] in ('\r', '\n'):
+                return pos
+            pos = page_content.find('---', pos + 1)
+        return -1
+
+    @classmethod
+    def parse_body(cls, page_content):
+        """Returns page properties as a dictionary, the text is in "text".
+        Only the header is scanned, the text is left alone."""
         options = {}
-        parts = re.split('[\r\n]+---[\r\n]+', page_content, 1)
-        if len(parts) == 2:
-            for line in re.split('[\r\n]+', parts[0]):
-                if not line.startswith('#'):
-                    kv = line.split(':', 1)
-                    if len(kv) == 2:
-                        k = kv[0].strip()
-                        v = kv[1].strip()
-                        if k.endswith('s'):
-                            v = re.split(',\s*', v)
-                        options[k] = v
-        options['text'] = parts[-1]
+        pos = cls.find_header_end(page_content)
+        if pos == -1:
+            options['text'] = page_content
+            return options
+        for line in re.split('[\r\n]+', page_content[:pos]):
+            if not line.startswith('#'):
+                kv = line.split(':', 1)
+                if len(kv) == 2:
+                    k = kv[0].strip()
+                    v = kv[1].strip()
+                    if k.endswith('s'):
+                        v = re.split(',\s*', v)
+                    options[k] = v
+        options['text'] = page_content[pos + 3:].lstrip('\r\n')
         return options
 
     @staticmethod
@@ -366,22 +1289,443 @@ class WikiContent(db.Model):
 
     @classmethod
     def find_geotagged(cls, label=None, limit=100):
-        """Returns geotagged pages."""
-        if label is None:
-            label = cls.GEOLABEL
-        label = label.replace('_', ' ')
-        pages = cls.gql('WHERE labels = :1 ORDER BY created DESC', label).fetch(limit)
-        pages = [p for p in pages if cls.GEOLABEL in p.labels]
-        return pages
+        """Returns recently created geotagged pages, optionally only those
+        with the specified label."""
+        query = cls.all().filter('labels =', cls.GEOLABEL)
+        if label and label.replace('_', ' ') != cls.GEOLABEL:
+            query.filter('labels =', label.replace('_', ' '))
+        return query.order('-created').fetch(limit)
+
+    @classmethod
+    def find_geotagged_in(cls, label, south, west, north, east, limit=500):
+        """Returns geotagged pages within the box, optionally only those with
+        the specified label.  Runs a geohash range query per cell that covers
+        the box (see util.geohash_cover)."""
+        if west > east:
+            # The box crosses the 180th meridian.
+            return cls.find_geotagged_in(label, south, west, north, 180.0, limit) + cls.find_geotagged_in(label, south, -180.0, north, east, limit)
+        label = (label or cls.GEOLABEL).replace('_', ' ')
+        if cls.has_geo_index():
+            pages = []
+            for prefix in util.geohash_cover(south, west, north, east):
+                query = cls.all().filter('labels =', label).filter('geohash >=', prefix).filter('geohash <', prefix + u'~')
+                pages.extend(query.fetch(limit))
+        else:
+            pages = cls.find_geotagged(label, limit=1000)
+        pages = [p for p in pages if p.geopt is not None and south <= p.geopt.lat <= north and west <= p.geopt.lon <= east]
+        return pages[:limit]
+
+    @classmethod
+    def has_geo_index(cls):
+        """Returns True if all geotagged pages have geohashes.  Wikis created
+        by older versions add them with /w/index/geo, until then queries by
+        area filter recent pages in memory."""
+        if cls._geo_index:
+            return True
+        ready = memcache.get('gaewiki:geo-index')
+        if ready is None:
+            ready = PageIndexStatus.get_by_key_name('geo') is not None
+            if not ready and cls.all(keys_only=True).filter('labels =', cls.GEOLABEL).get() is None:
+                PageIndexStatus(key_name='geo').put()
+                ready = True
+            memcache.set('gaewiki:geo-index', ready)
+        if ready:
+            cls._geo_index = True
+        return ready
+
+    @classmethod
+    def index_geotagged(cls, cursor=None, limit=20):
+        """Adds geohashes and marker HTML to a batch of geotagged pages.
+        Returns the cursor of the next batch, None when all pages have
+        them."""
+        query = cls.all().filter('labels =', cls.GEOLABEL).order('__key__')
+        pages, cursor = util.fetch_page(query, cursor, limit)
+        for page in pages:
+            page.geohash = util.geohash(page.geopt.lat, page.geopt.lon)
+        db.put(pages + [PageHtml.for_page(page) for page in pages])
+        if cursor is None:
+            PageIndexStatus(key_name='geo').put()
+            memcache.set('gaewiki:geo-index', True)
+        return cursor
+
+
+class BackLinks(db.Model):
+    """Titles of pages that link to the page named by the key name (see
+    key_name_for).  Maintained by WikiContent.put()."""
+    titles = db.StringListProperty(indexed=False)
+
+    # Saves that change more indexes than this update them in the task queue,
+    # see WikiContent.try_update_page_index().
+    MAX_SYNC_UPDATES = 20
+
+    @staticmethod
+    def key_name_for(title):
+        return WikiContent.key_name_for(title)
+
+    @classmethod
+    def update(cls, target, add, remove):
+        """Adds and removes linking page titles, in a transaction."""
+        db.run_in_transaction(cls.__update, cls.key_name_for(target), add, remove)
+
+    @classmethod
+    def update_all(cls, changes):
+        """Applies changes, a dictionary of (add, remove) tuples by target,
+        the same way as LabelIndex.update_all()."""
+        targets = changes.keys()
+        indexes = cls.get_by_key_name([cls.key_name_for(target) for target in targets])
+        for target, index in zip(targets, indexes):
+            add, remove = changes[target]
+            if cls.get_updated_titles(index, add, remove) is not None:
+                cls.update(target, add, remove)
+
+    @staticmethod
+    def get_updated_titles(index, add, remove):
+        """Returns titles of the index after the change, None if it doesn't
+        change anything."""
+        titles = []
+        if index is not None:
+            titles = index.titles
+        updated = [t for t in titles if t not in remove or t in add]
+        updated.extend([t for t in add if t not in updated])
+        if updated == titles:
+            return None
+        return updated
+
+    @classmethod
+    def __update(cls, key_name, add, remove):
+        index = cls.get_by_key_name(key_name)
+        titles = cls.get_updated_titles(index, add, remove)
+        if titles is None:
+            return
+        if index is None:
+            index = cls(key_name=key_name)
+        if titles:
+            index.titles = titles
+            index.put()
+        elif index.is_saved():
+            index.delete()
+
+
+class LabelIndex(db.Model):
+    """Pages that have the label named by the key name, with everything that
+    label listings show.  The lists are parallel, see get_entries().
+    Maintained by WikiContent.put()."""
+    titles = db.StringListProperty(indexed=False)
+    display_titles = db.StringListProperty(indexed=False)
+    redirects = db.StringListProperty(indexed=False)
+    created = db.ListProperty(datetime.datetime, indexed=False)
+
+    @staticmethod
+    def key_name_for(label):
+        return u'label:' + label
+
+    def get_entries(self):
+        """Returns (title, display_title, redirect, created) tuples."""
+        return zip(self.titles, self.display_titles, self.redirects, self.created)
+
+    @classmethod
+    def update(cls, label, add, remove):
+        """Adds or replaces entries and removes entries by title, in a
+        transaction."""
+        db.run_in_transaction(cls.__update, cls.key_name_for(label), add, remove)
+
+    @classmethod
+    def update_all(cls, changes):
+        """Applies changes, a dictionary of (add, remove) tuples by label.
+        Indexes are loaded with one get first, transactions only run for
+        those that would change."""
+        labels = changes.keys()
+        indexes = cls.get_by_key_name([cls.key_name_for(label) for label in labels])
+        for label, index in zip(labels, indexes):
+            add, remove = changes[label]
+            if cls.get_updated_entries(index, add, remove) is not None:
+                cls.update(label, add, remove)
+
+    @staticmethod
+    def get_updated_entries(index, add, remove):
+        """Returns entries of the index after the change, None if it doesn't
+        change anything."""
+        entries = []
+        if index is not None:
+            entries = index.get_entries()
+        added = dict([(e[0], e) for e in add])
+        updated = [added.pop(e[0], e) for e in entries if e[0] not in remove or e[0] in added]
+        updated.extend([e for e in add if e[0] in added])
+        if updated == entries:
+            return None
+        return updated
+
+    @classmethod
+    def __update(cls, key_name, add, remove):
+        index = cls.get_by_key_name(key_name)
+        updated = cls.get_updated_entries(index, add, remove)
+        if updated is None:
+            return
+        if index is None:
+            index = cls(key_name=key_name)
+        if updated:
+            index.titles = [e[0] for e in updated]
+            index.display_titles = [e[1] for e in updated]
+            index.redirects = [e[2] for e in updated]
+            index.created = [e[3] for e in updated]
+            index.put()
+        elif index.is_saved():
+            index.delete()
+
+
+class PageSummary(db.Model):
+    """What page lists (the index, the sitemap, recent changes) show about a
+    page.  Stored by WikiContent.put() under the page's key name, so that
+    lists don't load page bodies."""
+    title = db.StringProperty()
+    display_title = db.StringProperty(indexed=False)
+    author = WikiUserReference()
+    updated = db.DateTimeProperty()
+    created = db.DateTimeProperty()
+    pread = db.BooleanProperty()
+    sort_key = db.StringProperty()
+
+    @classmethod
+    def for_page(cls, page):
+        return cls(key_name=WikiContent.key_name_for(page.title), title=page.title, display_title=page.get_display_title(), author=WikiContent.author.get_value_for_datastore(page), updated=page.updated, created=page.created, pread=page.pread, sort_key=cls.get_sort_key(page.title))
+
+    @staticmethod
+    def get_sort_key(title):
+        """Returns the key that orders the index: case-insensitive, with
+        ordinary pages before the ones in namespaces (e.g. "Label:")."""
+        if ':' in title:
+            return title.lower()
+        return ':' + title.lower()
+
+    @staticmethod
+    def key_for(title):
+        return db.Key.from_path('PageSummary', WikiContent.key_name_for(title))
+
+    def get_display_title(self):
+        return self.display_title
+
+
+class PageHtml(db.Model):
+    """The rendered body of a page and the HTML of its map marker, stored as
+    the page's child named "html", so that loading pages doesn't load them.
+    Both are valid while html_hash matches WikiContent.get_html_hash()."""
+    html = db.TextProperty()
+    html_hash = db.StringProperty(indexed=False)
+    map_html = db.TextProperty()
+
+    @classmethod
+    def key_for(cls, page_key):
+        return db.Key.from_path(cls.kind(), 'html', parent=page_key)
+
+    @classmethod
+    def for_page(cls, page, html=None):
+        """Returns an unsaved entity for the page, with the marker HTML if
+        the page is geotagged."""
+        map_html = None
+        if WikiContent.GEOLABEL in page.labels:
+            map_html = util.render_map_info(page)
+        return cls(parent=page.key(), key_name='html', html=html, html_hash=page.get_html_hash(), map_html=map_html)
+
+    @classmethod
+    def get_map_html(cls, pages):
+        """Returns the marker HTML of the geotagged pages, loaded with one
+        batch get; the stale and missing ones are rendered."""
+        stored = db.get([cls.key_for(page.key()) for page in pages])
+        result = []
+        for page, entity in zip(pages, stored):
+            if entity is not None and entity.map_html is not None and entity.html_hash == page.get_html_hash():
+                result.append(entity.map_html)
+            else:
+                result.append(util.render_map_info(page))
+        return result
+
+
+class NicknameReservation(db.Model):
+    """Claims a nickname for a WikiUser.  Keyed by the lowercase nickname, so
+    checking whether one is taken is a get, and claimed in a transaction with
+    the user (see WikiUser.put), so two users can't get the same one.
+    Nicknames of users created by older versions are reserved by
+    /w/migrate/nicknames."""
+    owner = db.ReferenceProperty(WikiUser, collection_name='nickname_reservations')
+
+    # Set to True once this process knows that all nicknames are reserved.
+    _complete = None
+
+    @classmethod
+    def key_for(cls, nickname):
+        return db.Key.from_path(cls.kind(), u'nickname:' + nickname.lower())
+
+    def get_owner_key(self):
+        return NicknameReservation.owner.get_value_for_datastore(self)
+
+    @classmethod
+    def is_complete(cls):
+        """Returns True if nicknames of all users are reserved, the same way
+        as WikiContent.has_page_index()."""
+        if cls._complete:
+            return True
+        ready = memcache.get('gaewiki:nickname-index')
+        if ready is None:
+            ready = NicknameIndexStatus.get_by_key_name('status') is not None
+            if not ready and WikiUser.all(keys_only=True).get() is None:
+                NicknameIndexStatus(key_name='status').put()
+                ready = True
+            memcache.set('gaewiki:nickname-index', ready)
+        if ready:
+            cls._complete = True
+        return ready
+
+    @classmethod
+    def is_taken_by_legacy_user(cls, nickname, user):
+        """Returns True if a user other than the specified one has the
+        nickname but no reservation for it.  Only possible until
+        /w/migrate/nicknames completes, after that no query is made."""
+        if cls.is_complete():
+            return False
+        other = WikiUser.gql('WHERE nickname = :1', nickname).get()
+        return other is not None and other.key() != get_key_or_none(user)
+
+    @classmethod
+    def reserve_batch(cls, cursor=None, limit=50):
+        """Reserves nicknames of a batch of users.  Returns the cursor of the
+        next batch, None when all users were processed."""
+        wiki_users, cursor = util.fetch_page(WikiUser.all().order('__key__'), cursor, limit)
+        wiki_users = [u for u in wiki_users if u.nickname]
+        keys = [cls.key_for(u.nickname) for u in wiki_users]
+        reserved = dict(zip(keys, db.get(keys)))
+        reservations = []
+        for wiki_user, key in zip(wiki_users, keys):
+            if reserved[key] is None:
+                reserved[key] = cls(key=key, owner=wiki_user.key())
+                reservations.append(reserved[key])
+            elif reserved[key].get_owner_key() != wiki_user.key():
+                logging.warning(u'Nickname %s is used by more than one user.' % wiki_user.nickname)
+        db.put(reservations)
+        if cursor is None:
+            NicknameIndexStatus(key_name='status').put()
+            memcache.set('gaewiki:nickname-index', True)
+        return cursor
+
+
+class NicknameIndexStatus(db.Model):
+    """Exists once NicknameReservation covers all users."""
+
+
+class PageIndexStatus(db.Model):
+    """Exists once BackLinks and LabelIndex cover all pages ("status"), or
+    once all geotagged pages have geohashes ("geo")."""
+
+
+class ImportJob(db.Model):
+    """A data import running in the task queue, see run_batch().  The file
+    is processed line by line; position is the offset of the first line
+    that wasn't imported.  Old exports, which keep everything in one line,
+    are converted to JSON lines by the first batch."""
+    blob = blobstore.BlobReferenceProperty()
+    size = db.IntegerProperty()
+    merge = db.BooleanProperty(default=False)
+    position = db.IntegerProperty(default=0)
+    imported = db.IntegerProperty(default=0)
+    started = db.DateTimeProperty(auto_now_add=True)
+    finished = db.DateTimeProperty()
+
+    def run_batch(self, batch_size=50):
+        """Imports the next batch of pages and revisions and saves the
+        progress.  Returns False when the whole file was imported."""
+        if self.position == 0:
+            self.convert_legacy_export()
+        reader = blobstore.BlobReader(ImportJob.blob.get_value_for_datastore(self), buffer_size=256 * 1024)
+        reader.seek(self.position)
+        items = []
+        while len(items) < batch_size:
+            line = reader.readline()
+            if not line:
+                break
+            items.extend(parse_export(line))
+            self.position = reader.tell()
+
+        # WikiUser entities of authors by email, get_or_create() costs a query.
+        authors = {}
+        pages = [item for item in items if item['kind'] == 'page']
+        if pages:
+            self.imported += WikiContent.import_pages(pages, self.merge, authors)
+        revisions = [item for item in items if item['kind'] == 'revision']
+        if revisions:
+            self.imported += WikiContent.import_revisions(revisions, self.merge, authors)
+        if len(items) < batch_size:
+            self.finished = datetime.datetime.now()
+        self.put()
+        if self.finished is not None:
+            blobstore.delete(ImportJob.blob.get_value_for_datastore(self))
+            return False
+        return True
+
+    def convert_legacy_export(self):
+        """Rewrites an old export, a single dictionary keyed by title, as a
+        new blob of JSON lines, so that batches don't parse the whole file
+        again.  Files in the current format are left alone."""
+        old_key = ImportJob.blob.get_value_for_datastore(self)
+        reader = blobstore.BlobReader(old_key, buffer_size=256 * 1024)
+        line = reader.readline()
+        if not line.strip() or 'kind' in simplejson.loads(line):
+            return
+        items = parse_export(line + reader.read())
+
+        name = files.blobstore.create(mime_type='application/json')
+        output = files.open(name, 'a')
+        try:
+            for start in range(0, len(items), 100):
+                output.write(''.join([simplejson.dumps(item) + '\n' for item in items[start:start + 100]]))
+        finally:
+            output.close()
+        files.finalize(name)
+        new_key = files.blobstore.get_blob_key(name)
+        logging.info(u'Converted %u pages of an old export to JSON lines.' % len(items))
+
+        self.blob = new_key
+        self.size = blobstore.BlobInfo.get(new_key).size
+        self.put()
+        blobstore.delete(old_key)
+
+    def get_status(self):
+        return {
+            'imported': self.imported,
+            'position': self.position,
+            'size': self.size,
+            'done': self.finished is not None,
+        }
+
+
+def parse_export(data):
+    """Returns pages and revisions from an export file (or a part of it), as
+    dictionaries with a "kind".  Reads JSON lines written by /w/data/export,
+    skipping the lines that link to the next part, and the single dictionary
+    keyed by title written by older versions."""
+    items = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        item = simplejson.loads(line)
+        if 'kind' not in item:
+            for title, content in sorted(item.items()):
+                content['kind'] = 'page'
+                content['title'] = title
+                items.append(content)
+        elif item['kind'] in ('page', 'revision'):
+            items.append(item)
+    return items
 
 
 class WikiRevision(db.Model):
     """
-    Stores older revisions of pages.
+    Stores older revisions of pages.  Texts are stored in RevisionText child
+    entities so that history listings don't load them; revisions written by
+    older versions keep them in revision_body until /w/migrate/revisions
+    moves them.
     """
     title = db.StringProperty()
     wiki_page = db.ReferenceProperty(WikiContent)
-    revision_body = db.TextProperty(required=True)
+    revision_body = db.TextProperty()
     author = db.ReferenceProperty(WikiUser)
     created = db.DateTimeProperty(auto_now_add=True)
     pread = db.BooleanProperty()
@@ -393,3 +1737,98 @@ class WikiRevision(db.Model):
     @classmethod
     def get_by_key(cls, key):
         return db.Model.get(db.Key(key))
+
+    def get_body(self):
+        return self.get_bodies([self])[0]
+
+    @classmethod
+    def get_bodies(cls, revisions):
+        """Returns texts of the revisions.  Texts are loaded with one batch
+        get, snapshots that deltas refer to with another one (see
+        RevisionText.load_snapshots)."""
+        keys = [RevisionText.key_for(r.key()) for r in revisions if r.revision_body is None]
+        texts = dict(zip(keys, db.get(keys)))
+        bases = list(set([t.base for t in texts.values() if t is not None and t.base]))
+        snapshots = RevisionText.load_snapshots(bases)
+        bodies = []
+        for revision in revisions:
+            if revision.revision_body is not None:
+                bodies.append(revision.revision_body)
+                continue
+            text = texts[RevisionText.key_for(revision.key())]
+            if text is None:
+                bodies.append(None)
+            else:
+                bodies.append(text.get_text(snapshots.get(text.base)))
+        return bodies
+
+    @classmethod
+    def compress_batch(cls, cursor=None, limit=50):
+        """Moves texts of a batch of revisions written by older versions to
+        snapshot RevisionText entities.  Returns the cursor of the next batch,
+        None when all revisions were processed."""
+        revisions, cursor = util.fetch_page(cls.all().order('__key__'), cursor, limit)
+        entities = []
+        for revision in revisions:
+            if revision.revision_body is not None:
+                entities.append(RevisionText.build(revision.key(), revision.revision_body))
+                revision.revision_body = None
+                entities.append(revision)
+        if entities:
+            logging.info(u'Compressed %u revision texts.' % (len(entities) / 2))
+            db.put(entities)
+        return cursor
+
+
+class RevisionText(db.Model):
+    """
+    Stores the text of a WikiRevision, as its child named "text".  The text is
+    either a zlib-compressed snapshot, or a compressed delta (see
+    util.make_delta) against the snapshot of the revision named by base.
+    """
+    data = db.BlobProperty()
+    base = db.StringProperty(indexed=False)
+
+    @classmethod
+    def key_for(cls, revision_key):
+        return db.Key.from_path(cls.kind(), 'text', parent=revision_key)
+
+    @classmethod
+    def build(cls, revision_key, text, base_key=None, base_text=None):
+        """Returns an unsaved text entity for the revision: a delta against
+        base_text if one is given and the delta is less than half the size
+        of the snapshot, otherwise a snapshot."""
+        snapshot = zlib.compress(text.encode('utf-8'))
+        if base_text is not None:
+            delta = zlib.compress(util.make_delta(base_text, text))
+            if len(delta) * 2 < len(snapshot):
+                return cls(parent=revision_key, key_name='text', data=db.Blob(delta), base=base_key)
+        return cls(parent=revision_key, key_name='text', data=db.Blob(snapshot))
+
+    @classmethod
+    def load_snapshots(cls, revision_keys):
+        """Returns a dictionary of snapshot texts by revision key string.
+        Snapshots never change, so they are cached in memcache; the missing
+        ones are loaded with one batch get."""
+        texts = memcache.get_multi(revision_keys, key_prefix='RevisionSnapshot:')
+        missing = [key for key in revision_keys if key not in texts]
+        if missing:
+            loaded = {}
+            entities = db.get([cls.key_for(db.Key(key)) for key in missing])
+            for key, entity in zip(missing, entities):
+                if entity is not None:
+                    loaded[key] = entity.get_text()
+            memcache.set_multi(loaded, key_prefix='RevisionSnapshot:')
+            texts.update(loaded)
+        return texts
+
+    def get_text(self, base_text=None):
+        """Returns the text, None if it's a delta and the snapshot it refers
+        to (base_text) is missing."""
+        data = zlib.decompress(self.data)
+        if self.base is None:
+            return data.decode('utf-8')
+        if base_text is None:
+            logging.error(u'Snapshot %s of revision text %s is missing.' % (self.base, self.key()))
+            return None
+        return util.apply_delta(base_text, data)
@@ -1,5 +1,8 @@
 # encoding=utf-8
 
+import re
+
+import cache
 import model
 import util
 
@@ -8,6 +11,16 @@ from google.appengine.api import memcache
 
 SETTINGS_PAGE_NAME = 'gaewiki:settings'
 
+# Parsed settings, cached in process memory.  The version is compared with
+# the "settings" cache generation once per request (see begin_request).
+settings = None
+settings_version = None
+version_checked = False
+
+# Values derived from settings, built on demand: key => set or pattern.
+sets = {}
+patterns = {}
+
 DEFAULT_SETTINGS = """wiki_title: Web Intents 
 start_page: Welcome
 admin_email: paulkinlan@google.com 
@@ -29,29 +42,73 @@ Edit me."""
 
 def get_host_page():
     """Returns the page that hosts the settings."""
-    page = model.WikiContent.gql('WHERE title = :1', SETTINGS_PAGE_NAME).get()
+    page = model.WikiContent.get_by_title(SETTINGS_PAGE_NAME, create_if_none=False)
     if page is None:
         page = model.WikiContent(title=SETTINGS_PAGE_NAME, body=DEFAULT_SETTINGS)
         page.put()
     return page
 
 
+def begin_request():
+    """Makes the next get_all() call check whether settings were changed."""
+    global version_checked
+    version_checked = False
+
+
 def get_all():
-    settings = memcache.get('gaewiki:settings')
-    if settings is None:
-        settings = util.parse_page(get_host_page().body)
-        memcache.set('gaewiki:settings', settings)
+    global version_checked
+    if settings is None or not version_checked:
+        version = cache.get_generations(['settings'])['settings']
+        version_checked = True
+        if settings is None or version != settings_version:
+            load(version)
     return settings
 
 
+def load(version):
+    """Loads settings from memcache or the host page."""
+    global settings, settings_version, sets, patterns
+    cached = memcache.get('gaewiki:settings')
+    if cached is not None and cached[0] == version:
+        parsed = cached[1]
+    else:
+        parsed = get_host_page().get_parsed_body()
+        memcache.set('gaewiki:settings', (version, parsed))
+    settings = parsed
+    settings_version = version
+    sets = {}
+    patterns = {}
+
+
 def get(key, default_value=None):
     return get_all().get(key, default_value)
 
 
+def get_set(key):
+    """Returns a list setting (e.g. editors) as a set."""
+    get_all()
+    if key not in sets:
+        sets[key] = set(get(key) or [])
+    return sets[key]
+
+
+def get_pattern(key):
+    """Returns a compiled regular expression from a setting (e.g.
+    page-blacklist), None if it's not set."""
+    get_all()
+    if key not in patterns:
+        value = get(key)
+        patterns[key] = value is not None and re.compile(value) or None
+    return patterns[key]
+
+
 def check_and_flush(page):
-    """Empties settings cache if the host page is updated."""
+    """Empties settings cache if the host page is updated.  Cached pages
+    are rendered with the settings, so they are invalidated too."""
+    global settings
     if page.title == SETTINGS_PAGE_NAME:
-        memcache.delete('gaewiki:settings')
+        settings = None
+        cache.bump(['settings', 'wiki'])
 
 
 def change(upd):
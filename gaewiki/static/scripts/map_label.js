@@ -1,20 +1,25 @@
+var map, iw, added = {};
+
 google.maps.event.addDomListener(window, 'load', function () {
 	var sw = new google.maps.LatLng(map_data.bounds.minlat, map_data.bounds.minlng);
 	var ne = new google.maps.LatLng(map_data.bounds.maxlat, map_data.bounds.maxlng);
 	var bounds = new google.maps.LatLngBounds(sw, ne);
 
-	var map = new google.maps.Map(document.getElementById("map_canvas"), {
+	map = new google.maps.Map(document.getElementById("map_canvas"), {
 		zoom: 2,
 		center: bounds.getCenter(),
 		mapTypeId: google.maps.MapTypeId.HYBRID
 	});
 
-	var iw = new google.maps.InfoWindow({
+	iw = new google.maps.InfoWindow({
 		maxWidth: 300
 	});
 
-	for (var idx = 0; idx < map_data.markers.length; idx++) {
-		add_marker(map, map_data.markers[idx], iw);
+	add_map_data(map_data);
+
+	// Only recent pages were loaded, load the rest as the map is moved.
+	if (map_data.more_url) {
+		google.maps.event.addListener(map, 'idle', load_visible_markers);
 	}
 
 	var ctl = document.getElementById('popout');
@@ -29,6 +34,37 @@ google.maps.event.addDomListener(window, 'load', function () {
 	map.fitBounds(bounds);
 });
 
+function load_visible_markers()
+{
+	var bounds = map.getBounds();
+	if (!bounds)
+		return;
+	var sw = bounds.getSouthWest();
+	var ne = bounds.getNorthEast();
+	// Rounded outwards, so that nearby views share cached responses.
+	var bbox = [
+		Math.floor(sw.lat() * 100) / 100,
+		Math.floor(sw.lng() * 100) / 100,
+		Math.ceil(ne.lat() * 100) / 100,
+		Math.ceil(ne.lng() * 100) / 100
+	];
+	var script = document.createElement('script');
+	script.type = 'text/javascript';
+	script.src = map_data.more_url + bbox.join(',');
+	document.getElementsByTagName('head')[0].appendChild(script);
+}
+
+function add_map_data(data)
+{
+	for (var idx = 0; idx < data.markers.length; idx++) {
+		var s = data.markers[idx];
+		if (!added[s.title]) {
+			added[s.title] = true;
+			add_marker(map, s, iw);
+		}
+	}
+}
+
 function add_marker(map, s, iw)
 {
 	var marker = new google.maps.Marker({
@@ -55,7 +55,7 @@ def wikify(text, page_title=None):
 
 @register.filter
 def wikify_page(page):
-    return util.wikify_filter(page.body, page_name=page.title)
+    return page.get_html()
 
 
 @register.filter
@@ -2,10 +2,15 @@
 
 import unittest
 
+from google.appengine.api import memcache
 from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
 from google.appengine.ext import testbed
 
 import access
+import cache
+import diff
 import model
 import settings
 import util
@@ -23,7 +28,8 @@ class TestCase(unittest.TestCase):
     def setUp(self):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
-        self.testbed.init_datastore_v3_stub()
+        # High replication, so that cross-group transactions work.
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
         self.testbed.init_memcache_stub()
         settings.settings = None
 
@@ -55,6 +61,20 @@ class TestCase(unittest.TestCase):
         args = util.parse_page('key: value\nkeys: one, two\n#ignore: me\r---\rhello, world.')
         self.assertEquals(3, len(args))
 
+    def test_parsed_body(self):
+        """Makes sure parsed bodies are reused until the body changes."""
+        page = model.WikiContent(title='foo', body='key: value\n---\n# foo\n\n---\n\nbar')
+        parsed = page.get_parsed_body()
+        self.assertEquals('value', parsed['key'])
+        self.assertEquals('# foo\n\n---\n\nbar', parsed['text'])
+        self.assertTrue(parsed is page.get_parsed_body())
+
+        page.set_property('key', 'other')
+        self.assertEquals('value', parsed['key'])
+        self.assertEquals('other', page.get_property('key'))
+
+        self.assertEquals({'text': '---\nno header'}, util.parse_page('---\nno header'))
+
     def test_page_url(self):
         """Makes sure we can build correct page URLs."""
         self.assertEquals('/foo', util.pageurl('foo'))
@@ -82,6 +102,12 @@ class TestCase(unittest.TestCase):
         for got, wanted in checks:
             self.assertEquals(util.wikify(got), wanted)
 
+    def test_wikify_existing_pages(self):
+        self.assertEquals(util.wikify('[[foo]]'), '<a class="int missing" href="/w/edit?page=foo" title="foo (create)">foo</a>')
+        model.WikiContent(title='foo', body='# foo').put()
+        model.WikiContent(title='foo bar', body='# foo bar').put()
+        self.assertEquals(util.wikify('[[foo]], [[foo_bar|baz]], [[qux]]'), '<a class="int" href="/foo" title="foo">foo</a>, <a class="int" href="/foo_bar" title="foo_bar">baz</a>, <a class="int missing" href="/w/edit?page=qux" title="qux (create)">qux</a>')
+
     def test_page_creation(self):
         self.assertEquals(len(model.WikiContent.get_all()), 0)
         model.WikiContent(title='foo').put()
@@ -125,6 +151,21 @@ class TestCase(unittest.TestCase):
         settings.change({'editors': 'one, two'})
         self.assertEquals(settings.get('editors'), ['one', 'two'])
 
+    def test_settings_caching(self):
+        settings.change({'editors': 'one, two', 'page-blacklist': '^foo'})
+        self.assertEquals(settings.get_set('editors'), set(['one', 'two']))
+        self.assertTrue(settings.get_pattern('page-blacklist').match('foobar'))
+        self.assertEquals(settings.get_pattern('page-whitelist'), None)
+
+        # Changes made by other processes are noticed on the next request.
+        page = settings.get_host_page()
+        page.body = 'editors: three\n---\n'
+        db.Model.put(page)
+        cache.bump(['settings'])
+        self.assertEquals(settings.get_set('editors'), set(['one', 'two']))
+        settings.begin_request()
+        self.assertEquals(settings.get_set('editors'), set(['three']))
+
     def test_uurlencode_filter(self):
         self.assertEquals(util.uurlencode(None), '')
         self.assertEquals(util.uurlencode('foo bar'), 'foo_bar')
@@ -245,6 +286,18 @@ class TestCase(unittest.TestCase):
         page.put()
         self.assertEquals(access.can_read_page('foo', user, False), True)
 
+    def test_access_properties(self):
+        page = model.WikiContent(title='foo', body='private: yes\nreaders: alice@example.com\n---\n# foo')
+        page.put()
+        self.assertEquals((True, False, ['alice@example.com'], []), model.WikiContent.get_access_by_title('foo'))
+
+        # Pages saved by older versions have no access properties.
+        page.private = None
+        page.readers = []
+        db.Model.put(page)
+        memcache.delete('PageAccess:foo')
+        self.assertEquals((True, False, ['alice@example.com'], []), model.WikiContent.get_access_by_title('foo'))
+
     def test_access_to_special_pages(self):
         user = users.User('alice@example.com')
 
@@ -293,6 +346,105 @@ class TestCase(unittest.TestCase):
         p2 = model.WikiContent.get_by_title('Hello_World')
         self.assertEquals(p1.key(), p2.key())
 
+    def test_title_keys(self):
+        page = model.WikiContent(title='foo_bar', body='# foo bar')
+        page.put()
+        self.assertEquals(page.key().name(), u'title:foo bar')
+        self.assertEquals(model.WikiContent.get_by_title('foo bar').key(), page.key())
+        # Key names are limited to 500 bytes.
+        self.assertRaises(ValueError, model.WikiContent(title=u'я' * 250, body='# long').put)
+
+    def test_page_renaming(self):
+        page = model.WikiContent(title='foo', body='# foo')
+        page.put()
+        uuid = page.uuid
+
+        page = page.update('name: bar\n---\n# bar', None, 'renamed', False)
+        self.assertEquals(page.key().name(), u'title:bar')
+        self.assertEquals(model.WikiContent.get_by_title('foo', create_if_none=False), None)
+
+        page = model.WikiContent.get_by_title('bar')
+        self.assertEquals(page.uuid, uuid)
+        self.assertEquals(len(page.get_history()), 1)
+
+    def test_stored_html(self):
+        page = model.WikiContent(title='foo', body='# foo\n\nSee [[bar]].')
+        page.put()
+        self.assertTrue('class="int missing"' in page.get_html())
+
+        page = model.WikiContent.get_by_title('foo')
+        stored = model.PageHtml.get(model.PageHtml.key_for(page.key()))
+        self.assertEquals(stored.html_hash, page.get_html_hash())
+        self.assertTrue('class="int missing"' in stored.html)
+
+        model.WikiContent(title='bar', body='# bar').put()
+        page = model.WikiContent.get_by_title('foo')
+        self.assertEquals(None, model.PageHtml.get(model.PageHtml.key_for(page.key())))
+
+        # Replaced bodies (previews, old revisions) aren't stored.
+        page.body = '# foo\n\nSee [[baz]].'
+        self.assertTrue('class="int missing"' in page.get_html())
+        self.assertEquals(None, model.PageHtml.get(model.PageHtml.key_for(page.key())))
+        page = model.WikiContent.get_by_title('foo')
+        self.assertTrue('class="int"' in page.get_html())
+
+    def test_cache_generations(self):
+        key = cache.get_versioned_key('Index:')
+        self.assertEquals(key, cache.get_versioned_key('Index:'))
+
+        cache.bump_wiki()
+        self.assertNotEquals(key, cache.get_versioned_key('Index:'))
+        key = cache.get_versioned_key('Index:')
+
+        # Counters survive memcache flushes.
+        memcache.flush_all()
+        self.assertEquals(key, cache.get_versioned_key('Index:'))
+
+        key = cache.get_versioned_key('PagesFeed:foo', ['foo'])
+        cache.bump_labels(['bar'])
+        self.assertEquals(key, cache.get_versioned_key('PagesFeed:foo', ['foo']))
+        cache.bump_labels(['foo'])
+        self.assertNotEquals(key, cache.get_versioned_key('PagesFeed:foo', ['foo']))
+
+    def test_chrome_flushing(self):
+        generations = cache.get_generations(['chrome', 'wiki'])
+        model.WikiContent(title='foo', body='# foo').put()
+        self.assertEquals(generations, cache.get_generations(['chrome', 'wiki']))
+        model.WikiContent(title='gaewiki:sidebar', body='# sidebar').put()
+        self.assertNotEquals(generations['chrome'], cache.get_generations(['chrome'])['chrome'])
+        # Cached pages embed the sidebar.
+        self.assertNotEquals(generations['wiki'], cache.get_generations(['wiki'])['wiki'])
+
+        generations = cache.get_generations(['chrome'])
+        model.WikiContent.get_by_title('gaewiki:sidebar').update(None, None, None, True)
+        self.assertNotEquals(generations, cache.get_generations(['chrome']))
+
+        key = cache.get_versioned_key('Page:foo')
+        settings.change({'wiki_title': 'Test'})
+        self.assertNotEquals(key, cache.get_versioned_key('Page:foo'))
+
+    def test_identity_map(self):
+        model.WikiContent(title='foo', body='# foo').put()
+        model.begin_request()
+        try:
+            page = model.WikiContent.get_by_title('foo')
+            self.assertTrue(page is model.WikiContent.get_by_title('foo'))
+            self.assertEquals(model.WikiContent.get_by_title('bar', create_if_none=False), None)
+
+            page.update('# foo\n\nUpdated.', None, 'updated', False)
+            self.assertTrue(page is model.WikiContent.get_by_title('foo'))
+
+            # Previews don't leak into later lookups.
+            model.WikiContent.forget('foo')
+            page.body = 'locked: yes\n---\n# foo'
+            self.assertFalse(model.WikiContent.get_by_title('foo').is_locked())
+            page = model.WikiContent.get_by_title('foo')
+
+            page.update(None, None, None, True)
+            self.assertEquals(model.WikiContent.get_by_title('foo', create_if_none=False), None)
+        finally:
+            model.end_request()
+
     def test_page_redirect(self):
         """Makes sure that redirects are supported when displaying pages."""
         if not TEST_VIEWS:
@@ -333,6 +485,19 @@ class TestCase(unittest.TestCase):
         links = util.extract_links(text)
         self.assertEquals(links, ["foo"])
 
+        text = "[[List:foo;sort=date,desc]], [[ListChildren:]]"
+        self.assertEquals(["List:foo", "ListChildren:bar"], util.extract_links(text, "bar"))
+
+    def test_dependent_titles(self):
+        model.WikiContent(title='index', body='[[List:city]]').put()
+        model.WikiContent(title='moscow', body='[[ListChildren:]]').put()
+        model.WikiContent(title='capital', body='redirect: moscow\n---\n').put()
+        model.WikiContent(title='moscow/kremlin', body='labels: city\n---\n# Kremlin').put()
+
+        kremlin = model.WikiContent.get_by_title('moscow/kremlin')
+        self.assertEquals(['index', 'moscow'], sorted(model.WikiContent.find_dependent_titles([kremlin.title], kremlin.labels)))
+        self.assertEquals(['capital'], model.WikiContent.find_dependent_titles(['moscow'], []))
+
     def test_backlinks(self):
         page = model.WikiContent(title="test", body="[[foo]], [[bar]]")
         page.put()
@@ -341,6 +506,239 @@ class TestCase(unittest.TestCase):
         page2 = model.WikiContent(title="foo", body=None)
         self.assertEquals(page2.get_backlinks()[0].title, page.title)
 
+    def test_page_index(self):
+        page = model.WikiContent(title='foo', body='labels: bar\n---\n# foo\n\n[[baz]], [[qux_quux]]')
+        page.put()
+        self.assertEquals(['foo'], model.WikiContent.find_backlink_titles(['qux quux']))
+        self.assertEquals([('foo', 'foo', '', page.created)], model.WikiContent.get_label_entries('bar'))
+
+        page.body = 'labels: bar\ndisplay_title: Foo\n---\n# foo\n\n[[baz]]'
+        page.put()
+        self.assertEquals([], model.WikiContent.find_backlink_titles(['qux quux']))
+        self.assertEquals(['Foo'], [e[1] for e in model.WikiContent.get_label_entries('bar')])
+        # Saving the page again doesn't change its label entry.
+        index = model.LabelIndex.get_by_key_name(model.LabelIndex.key_name_for('bar'))
+        self.assertEquals(None, model.LabelIndex.get_updated_entries(index, [page.get_label_entry()], []))
+        # Only links that appear or disappear change backlinks.
+        self.assertEquals({}, page.get_backlink_changes(page.title, page.links))
+        self.assertEquals({'qux': ([], ['foo'])}, page.get_backlink_changes(page.title, page.links + ['qux']))
+        index = model.BackLinks.get_by_key_name(model.BackLinks.key_name_for('baz'))
+        self.assertEquals(None, model.BackLinks.get_updated_titles(index, ['foo'], []))
+
+        page.body = 'name: foo2\nlabels: bar\n---\n# foo\n\n[[baz]]'
+        page = page.put()
+        self.assertEquals(['foo2'], model.WikiContent.find_backlink_titles(['baz']))
+        self.assertEquals(['foo2'], [e[0] for e in model.WikiContent.get_label_entries('bar')])
+
+        page.update(None, None, None, True)
+        self.assertEquals([], model.WikiContent.find_backlink_titles(['baz']))
+        self.assertEquals([], model.WikiContent.get_label_entries('bar'))
+
+    def test_page_summaries(self):
+        page = model.WikiContent(title='foo', body='display_title: Foo\n---\n# foo')
+        page.put()
+        pages = model.WikiContent.get_all()
+        self.assertTrue(isinstance(pages[0], model.PageSummary))
+        self.assertEquals(('foo', 'Foo'), (pages[0].title, pages[0].get_display_title()))
+
+        page.body = 'name: bar\n---\n# bar'
+        page = page.put()
+        self.assertEquals(['bar'], [p.title for p in model.WikiContent.get_changes()])
+
+        page.update(None, None, None, True)
+        self.assertEquals([], model.WikiContent.get_all())
+
+    def test_list_pagination(self):
+        self.assertTrue(model.WikiContent.has_page_index())
+        for title in ('Label:a', 'c', 'B', 'a', 'd'):
+            model.WikiContent(title=title, body='# ' + title).put()
+        pages, cursor = model.WikiContent.fetch_index(limit=2)
+        self.assertEquals(['a', 'B'], [p.title for p in pages])
+        pages, cursor = model.WikiContent.fetch_index(cursor, limit=2)
+        self.assertEquals(['c', 'd'], [p.title for p in pages])
+        pages, cursor = model.WikiContent.fetch_index(cursor, limit=2)
+        self.assertEquals(['Label:a'], [p.title for p in pages])
+        self.assertEquals(None, cursor)
+
+    def test_export(self):
+        page = model.WikiContent.get_by_title('foo')
+        page.update('# foo', users.User('alice@example.com'), 'created', False)
+        page.update('# foo\n\nUpdated.', users.User('alice@example.com'), 'updated', False)
+
+        items = []
+        positions = []
+        for batch, position in model.WikiContent.export(with_revisions=True, batch_size=1):
+            items.extend(batch)
+            positions.append(position)
+        self.assertEquals(['page', 'revision'], [item['kind'] for item in items])
+        self.assertEquals('alice@example.com', items[0]['author'])
+        self.assertEquals('# foo\n\nUpdated.', items[0]['body'])
+        self.assertEquals('# foo', items[1]['body'])
+        self.assertEquals(None, positions[-1])
+
+        # Resuming after the first batch skips the pages.
+        resumed = []
+        for batch, position in model.WikiContent.export(True, positions[0], batch_size=1):
+            resumed.extend(batch)
+        self.assertEquals(['revision'], [item['kind'] for item in resumed])
+
+    def test_import(self):
+        model.WikiContent(title='foo', body='# foo').put()
+        items = model.parse_export('{"kind": "page", "title": "foo", "author": "alice@example.com", "body": "# new foo"}\n'
+                                   '{"kind": "revision", "title": "foo", "body": "# old foo"}\n'
+                                   '{"bar": {"author": null, "body": "# bar"}}\n'
+                                   '{"kind": "next", "url": "http://localhost/w/data/export?position=page%3A"}\n')
+        self.assertEquals(['foo', 'foo', 'bar'], [item['title'] for item in items])
+        self.assertEquals(['page', 'revision', 'page'], [item['kind'] for item in items])
+        pages = [item for item in items if item['kind'] == 'page']
+
+        self.assertEquals(1, model.WikiContent.import_pages(pages, merge=True))
+        self.assertEquals('# foo', model.WikiContent.get_by_title('foo').body)
+
+        self.assertEquals(2, model.WikiContent.import_pages(pages))
+        page = model.WikiContent.get_by_title('foo')
+        self.assertEquals('# new foo', page.body)
+        self.assertEquals('alice@example.com', page.author.wiki_user.email())
+        self.assertEquals(['# foo'], model.WikiRevision.get_bodies(page.get_history(by_title=True)))
+
+        # Revisions join the page's history, once.
+        self.assertEquals(1, model.WikiContent.import_revisions(items[1:2]))
+        self.assertEquals(0, model.WikiContent.import_revisions(items[1:2], merge=True))
+        self.assertEquals(1, model.WikiContent.import_revisions(items[1:2]))
+        self.assertEquals(['# foo', '# old foo'], sorted(model.WikiRevision.get_bodies(page.get_history())))
+
+    def test_transactional_update(self):
+        user = users.User('alice@example.com')
+        page = model.WikiContent.get_by_title('foo')
+        page.update('# foo', user, 'created', False)
+        page.update('# foo\n\nUpdated.', user, 'updated', False)
+        self.assertEquals(model.WikiUser.get_or_create(user).key(), memcache.get('WikiUserKey:alice@example.com'))
+
+        revisions = page.get_history(by_title=True)
+        self.assertEquals(1, len(revisions))
+        self.assertEquals(page.key(), revisions[0].key().parent())
+        self.assertEquals('alice@example.com', revisions[0].author.wiki_user.email())
+
+    def test_uuid_migration(self):
+        page = model.WikiContent(title='foo', body='# foo')
+        db.Model.put(page)
+        model.WikiRevision(title='foo', revision_body='# old foo').put()
+
+        page = model.WikiContent.get_by_title('foo')
+        self.assertEquals(None, page.uuid)
+        self.assertEquals(None, model.WikiContent.get_by_title('foo').uuid)
+
+        self.assertEquals(None, model.WikiContent.migrate_uuids())
+        page = model.WikiContent.get_by_title('foo')
+        self.assertTrue(page.uuid)
+        self.assertEquals(['# old foo'], [r.revision_body for r in page.get_history()])
+
+    def test_revision_compression(self):
+        user = users.User('alice@example.com')
+        lines = [u'Line %u of the page.\n' % i for i in range(50)]
+        page = model.WikiContent.get_by_title('foo')
+        bodies = []
+        for i in range(15):
+            lines[i] = u'Changed line %u.\n' % i
+            bodies.append(u'# foo\n\n' + u''.join(lines))
+            page.update(bodies[-1], user, 'edit %u' % i, False)
+
+        revisions = page.get_history()
+        self.assertEquals(14, len(revisions))
+        self.assertEquals([None] * 14, [r.revision_body for r in revisions])
+        texts = db.get([model.RevisionText.key_for(r.key()) for r in revisions])
+        self.assertEquals(2, len([t for t in texts if t.base is None]))
+        self.assertEquals(list(reversed(bodies[:-1])), model.WikiRevision.get_bodies(revisions))
+        delta = [t for t in texts if t.base is not None][0]
+        self.assertEquals(None, delta.get_text(None))
+
+        legacy = model.WikiRevision(title='foo', revision_body=u'# old foo')
+        legacy.put()
+        self.assertEquals(None, model.WikiRevision.compress_batch())
+        legacy = model.WikiRevision.get(legacy.key())
+        self.assertEquals(None, legacy.revision_body)
+        self.assertEquals(u'# old foo', legacy.get_body())
+
+    def test_history_pagination(self):
+        alice = users.User('alice@example.com')
+        bob = users.User('bob@example.com')
+        page = model.WikiContent.get_by_title('foo')
+        for idx in range(5):
+            page.update('# foo\n\nVersion %u.' % idx, idx % 2 and bob or alice, 'edit %u' % idx, False)
+
+        revisions, cursor = page.fetch_history(limit=3)
+        self.assertEquals(['edit 3', 'edit 2', 'edit 1'], [r.comment for r in revisions])
+        self.assertTrue(cursor)
+        older, cursor = page.fetch_history(cursor, limit=3)
+        self.assertEquals(['edit 0'], [r.comment for r in older])
+        self.assertEquals(None, cursor)
+
+        model.WikiUser.prefetch(revisions)
+        self.assertEquals(['bob', 'alice', 'bob'], [r.author.get_nickname() for r in revisions])
+
+    def test_user_cache(self):
+        model.begin_request()
+        try:
+            user = users.User('bob@example.com', _user_id='123')
+            wiki_user = model.WikiUser.get_or_create(user)
+            self.assertEquals('id:123', wiki_user.key().name())
+            self.assertTrue(wiki_user is model.WikiUser.get_or_create(user))
+            self.assertEquals(wiki_user.key(), memcache.get('WikiUser:bob@example.com').key())
+
+            legacy = model.WikiUser(wiki_user=users.User('carol@example.com'), nickname='carol')
+            legacy.put()
+            self.assertEquals(legacy.key(), model.WikiUser.get_or_create(users.User('carol@example.com')).key())
+
+            page = model.WikiContent(title='foo', body='# foo', author=legacy.key())
+            summary = model.PageSummary(key_name=model.WikiContent.key_name_for('bar'), title='bar', author=wiki_user.key())
+            model.WikiUser.prefetch([page, summary])
+            self.assertEquals(['carol', 'bob'], [page.author.get_nickname(), summary.author.get_nickname()])
+        finally:
+            model.end_request()
+
+    def test_nickname_reservation(self):
+        bob = model.WikiUser.get_or_create(users.User('bob@example.com'))
+        self.assertEquals('bob', bob.nickname)
+        self.assertEquals(bob.key(), model.NicknameReservation.get(model.NicknameReservation.key_for('Bob')).get_owner_key())
+
+        other = model.WikiUser.get_or_create(users.User('bob@example.org'))
+        self.assertNotEquals('bob', other.nickname)
+        other.nickname = 'BOB'
+        self.assertRaises(RuntimeError, other.put)
+
+        bob.nickname = 'robert'
+        bob.put()
+        self.assertEquals(None, model.NicknameReservation.get(model.NicknameReservation.key_for('bob')))
+        other.put()
+        self.assertEquals('BOB', model.WikiUser.get(other.key()).nickname)
+
+    def test_geo_index(self):
+        model.WikiContent(title='Moscow', body='geo: 55.75, 37.62\nlabels: city\n---\n# Moscow').put()
+        model.WikiContent(title='Paris', body='geo: 48.86, 2.35\nlabels: city\n---\n# Paris').put()
+        model.WikiContent(title='Kremlin', body='geo: 55.75, 37.61\n---\n# Kremlin').put()
+        model.WikiContent(title='Berlin', body='labels: city\n---\n# Berlin').put()
+
+        page = model.WikiContent.get_by_title('Moscow')
+        self.assertEquals(util.geohash(55.75, 37.62), page.geohash)
+        self.assertTrue(model.PageHtml.get_map_html([page])[0].startswith('<h1><a target="_blank" href="/Moscow">Moscow</a></h1>'))
+        self.assertTrue(model.PageHtml.get(model.PageHtml.key_for(page.key())).map_html is not None)
+        self.assertEquals(None, model.WikiContent.get_by_title('Berlin').geohash)
+        self.assertEquals(['city'], page.get_property('labels'))
+
+        self.assertEquals(['Moscow', 'Paris'], sorted([p.title for p in model.WikiContent.find_geotagged('city')]))
+        self.assertEquals(None, model.WikiContent.index_geotagged())
+        self.assertTrue(model.WikiContent.has_geo_index())
+        self.assertEquals(['Kremlin', 'Moscow'], sorted([p.title for p in model.WikiContent.find_geotagged_in(None, 55, 37, 56, 38)]))
+        self.assertEquals(['Moscow'], [p.title for p in model.WikiContent.find_geotagged_in('city', 55, 37, 56, 38)])
+        self.assertEquals(['Paris'], [p.title for p in model.WikiContent.find_geotagged_in('city', 40, 170, 50, 10)])
+
+    def test_diff(self):
+        old = u'# foo\n\nThe quick <b>fox</b>.\nSame line.\nRemoved line.\n'
+        new = u'# foo\n\nThe slow <b>fox</b>.\nSame line.\nAdded line.\nAnother one.\n'
+        self.assertEquals(u'# foo\n\nThe <del>quick</del><ins>slow</ins> &lt;b&gt;fox&lt;/b&gt;.\nSame line.\n<del>Removed</del><ins>Added</ins> line.\n<ins>Another one.\n</ins>', diff.get_html(old, new))
+        self.assertEquals(u'a\n<ins>b\n</ins>c\n', diff.get_html(u'a\nc\n', u'a\nb\nc\n'))
+        self.assertEquals([('equal', 0, 1, 0, 1), ('delete', 1, 2, 1, 1), ('equal', 2, 3, 1, 2)], diff.get_opcodes(['a', 'b', 'c'], ['a', 'c']))
+
 
 def run_tests():
     suite = unittest.TestSuite()
@@ -1,11 +1,15 @@
 # encoding=utf-8
 
 import cgi
+import difflib
 import logging
 import os
 import re
+import threading
 import urllib
 
+from django.utils import simplejson
+
 import markdown
 import model
 import settings
@@ -14,6 +18,72 @@ import images
 
 cleanup_re_1 = re.compile('<h\d>.*', re.MULTILINE | re.DOTALL)
 
+# Configured Markdown instances, see get_markdown().
+markdown_pool = threading.local()
+
+
+class RpcCounter(threading.local):
+    """Counts API calls made by the current thread, by service.  Install the
+    hook method with apiproxy_stub_map.apiproxy.GetPostCallHooks().Append()."""
+    def __init__(self):
+        self.reset()
+
+    def hook(self, service, call, request, response):
+        self.calls[service] = self.calls.get(service, 0) + 1
+        self.received[service] = self.received.get(service, 0) + response.ByteSize()
+
+    def count(self, service):
+        return self.calls.get(service, 0)
+
+    def bytes_received(self, service):
+        """Returns the size of responses from the service, in bytes."""
+        return self.received.get(service, 0)
+
+    def reset(self):
+        self.calls = {}
+        self.received = {}
+
+
+def fetch_page(query, cursor=None, limit=100):
+    """Fetches a batch of query results, starting at the cursor.  Returns the
+    results and the cursor of the next batch, None if this one is the last
+    (the next batch can still turn out empty)."""
+    if cursor:
+        query.with_cursor(cursor)
+    items = query.fetch(limit)
+    next_cursor = None
+    if len(items) == limit:
+        next_cursor = query.cursor()
+    return items, next_cursor
+
+
+def make_delta(base, text):
+    """Describes text as a list of line ranges copied from base, [start, end],
+    and inserted strings.  Returns the list encoded as JSON, see
+    apply_delta()."""
+    base_lines = base.splitlines(True)
+    text_lines = text.splitlines(True)
+    delta = []
+    matcher = difflib.SequenceMatcher(None, base_lines, text_lines)
+    for opcode, a0, a1, b0, b1 in matcher.get_opcodes():
+        if opcode == 'equal':
+            delta.append([a0, a1])
+        elif b1 > b0:
+            delta.append(u''.join(text_lines[b0:b1]))
+    return simplejson.dumps(delta)
+
+
+def apply_delta(base, delta):
+    """Restores the text described by a delta made by make_delta()."""
+    base_lines = base.splitlines(True)
+    parts = []
+    for item in simplejson.loads(delta):
+        if isinstance(item, list):
+            parts.extend(base_lines[item[0]:item[1]])
+        else:
+            parts.append(item)
+    return u''.join(parts)
+
 
 def parse_page(page_content):
     return model.WikiContent.parse_body(page_content)
@@ -31,13 +101,16 @@ def pageurl_rel(title):
     return urllib.quote(title.replace(' ', '_'))
 
 
-def wikify_filter(text, display_title=None, page_name=None):
-    props = parse_page(text)
-    text = parse_markdown(props['text'])
+def wikify_filter(text, display_title=None, page_name=None, props=None):
+    """Renders a page body.  Pass props if the body was already parsed."""
+    if props is None:
+        props = parse_page(text)
 
     if props.get("format") == "plain":
         return cgi.escape(props["text"])
 
+    text = parse_markdown(props['text'])
+
     if display_title is None and 'display_title' in props:
         display_title = props['display_title']
 
@@ -50,21 +123,59 @@ def wikify_filter(text, display_title=None, page_name=None):
 
 
 def parse_markdown(text):
-    return markdown.markdown(text, settings.get('markdown-extensions', [])).strip()
+    return get_markdown(settings.get('markdown-extensions', [])).convert(text).strip()
+
+
+def get_markdown(extensions):
+    """Returns a Markdown instance with the specified extensions, ready to
+    convert a new document.  Building one loads the extensions and sets up
+    all processors, which costs more than converting a typical page, so
+    instances are reused: one per thread and extension list."""
+    instances = getattr(markdown_pool, 'instances', None)
+    if instances is None:
+        instances = markdown_pool.instances = {}
+    key = tuple(extensions)
+    md = instances.get(key)
+    if md is None:
+        md = instances[key] = markdown.Markdown(extensions=markdown.load_extensions(extensions))
+    md.reset()
+    return md
 
 
 WIKI_WORD_PATTERN = re.compile("\[\[(.+?)\]\]")
 
 
+DYNAMIC_LINK_PATTERN = re.compile("\[\[(List|ListChildren):")
+
+
+def has_dynamic_links(text):
+    """Returns True if the text lists pages by label, so that its rendered
+    form depends on other pages' labels."""
+    return DYNAMIC_LINK_PATTERN.search(text) is not None
+
+
 def wikify(text, title=None):
-    text, count = WIKI_WORD_PATTERN.subn(lambda x: wikify_one(x, title), text)
+    existing = model.WikiContent.find_existing_titles(find_link_targets(text))
+    text, count = WIKI_WORD_PATTERN.subn(lambda x: wikify_one(x, title, existing), text)
     text = re.sub(r'\.  ', '.&nbsp; ', text)
     text = re.sub(u' +(—|--) +', u'&nbsp;— ', text)
     return text
 
 
-def wikify_one(pat, real_page_title):
-    """Wikifies one link."""
+def find_link_targets(text):
+    """Returns names of all pages that the text links to, so that their
+    existence could be checked in one batch."""
+    targets = []
+    for link in WIKI_WORD_PATTERN.findall(text):
+        name = link.split('|', 1)[0]
+        if name not in targets:
+            targets.append(name)
+    return targets
+
+
+def wikify_one(pat, real_page_title, existing=None):
+    """Wikifies one link.  If existing is a set of known page titles, the
+    link target is checked against it instead of the datastore."""
     page_name = page_title = pat.group(1)
     if "|" in page_name:
         page_name, page_title = page_name.split("|", 1)
@@ -89,14 +200,18 @@ def wikify_one(pat, real_page_title):
             if iwlink:
                 return '<a class="iw iw-%s" href="%s" target="_blank">%s</a>' % (parts[0], iwlink.replace('%s', urllib.quote(parts[1].encode('utf-8'))), page_title)
 
-    page = model.WikiContent.get_by_title(page_name)
+    if existing is not None:
+        page_exists = page_name.replace('_', ' ') in existing
+    else:
+        page = model.WikiContent.get_by_title(page_name)
+        page_exists = page is not None and page.is_saved()
 
     page_class = "int"
     page_link = pageurl(page_name)
     page_hint = page_name
     page_text = page_title
 
-    if page is None or not page.is_saved():
+    if not page_exists:
         page_class += " missing"
         page_hint += " (create)"
         page_link = "/w/edit?page=" + pageurl_rel(page_name)
@@ -139,20 +254,20 @@ def render_image(args, title):
 def list_pages_by_label(label):
     """Returns a formatted list of pages with the specified label."""
     keys = label.split(';')
-    pages = model.WikiContent.get_by_label(keys[0])
+    entries = model.WikiContent.get_label_entries(keys[0])
 
     if 'sort=date,desc' in keys:
-        pages.sort(key=lambda p: p.created, reverse=True)
+        entries.sort(key=lambda e: e[3], reverse=True)
     else:
-        pages.sort(key=lambda p: p.title.lower())
+        entries.sort(key=lambda e: e[0].lower())
 
     items = []
-    for page in pages:
-        page_name = page.redirect or page.title
+    for title, display_title, redirect, created in entries:
+        page_name = redirect or title
         items.append(u'<li><a class="int" href="%(url)s" title="%(hint)s">%(title)s</a></li>' % {
             "url": pageurl(page_name),
             "hint": cgi.escape(page_name),
-            "title": page.get_property('display_title', page.title),
+            "title": display_title,
         })
 
     if not items:
@@ -255,7 +370,68 @@ def cleanup_summary(text):
     return text
 
 
-def extract_links(text):
+def render_map_info(page):
+    """Returns the HTML shown when a page's marker is clicked on the map.
+    Stored when the page is saved, see PageHtml."""
+    return u'<h1><a target="_blank" href="%s">%s</a></h1>\n%s' % (cgi.escape(pageurl(page.title)), cgi.escape(page.title), cleanup_summary(page.summary))
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(lat, lng, precision=12):
+    """Encodes a point as a geohash.  Points in the same cell share prefixes,
+    so a cell can be queried as a range of strings."""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    result = []
+    char = bit = 0
+    even = True
+    while len(result) < precision:
+        if even:
+            bounds, value = lng_range, lng
+        else:
+            bounds, value = lat_range, lat
+        middle = (bounds[0] + bounds[1]) / 2
+        if value >= middle:
+            char = char * 2 + 1
+            bounds[0] = middle
+        else:
+            char = char * 2
+            bounds[1] = middle
+        even = not even
+        bit += 1
+        if bit == 5:
+            result.append(GEOHASH_ALPHABET[char])
+            char = bit = 0
+    return ''.join(result)
+
+
+def geohash_cover(south, west, north, east, max_cells=8):
+    """Returns prefixes of the smallest geohash cells that cover the box,
+    with at most max_cells cells.  [''] stands for the whole world."""
+    best = ['']
+    for precision in range(1, 13):
+        lng_step = 360.0 / 2 ** ((5 * precision + 1) / 2)
+        lat_step = 180.0 / 2 ** (5 * precision / 2)
+        rows = int((north - south) / lat_step) + 2
+        cols = int((east - west) / lng_step) + 2
+        if rows * cols > max_cells * 4:
+            break
+        lats = [min(south + row * lat_step, north) for row in range(rows)]
+        lngs = [min(west + col * lng_step, east) for col in range(cols)]
+        cells = set([geohash(lat, lng, precision) for lat in lats for lng in lngs])
+        if len(cells) > max_cells:
+            break
+        best = sorted(cells)
+    return best
+
+
+def extract_links(text, title=None):
+    """Returns link targets found in the text.  Page lists are recorded as
+    links to "List:label" and "ListChildren:parent" (the page's own title
+    when the parent is omitted), so that pages that list a label can be
+    found in the backlink index."""
     if text is None:
         return []
 
@@ -265,9 +441,12 @@ def extract_links(text):
         if "|" in link:
             link = link.split("|", 1)[0]
 
-        if link.startswith("Image:"):
+        if link.startswith("Image:") or link.startswith("List:") or link.startswith("ListChildren:"):
             link = link.split(";")[0]
 
+        if link == "ListChildren:" and title is not None:
+            link = "ListChildren:" + title
+
         if link not in links:
             links.append(link)
 
@@ -2,15 +2,17 @@
 
 import logging
 import os
-import difflib
 from urllib import quote
 
 from django.utils import simplejson
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 
 import access
+import cache
+import diff
 import model
 import settings
 import util
@@ -27,6 +29,9 @@ Pages in this category:
 _This is an automatically generated page._
 """
 
+# Rendered sidebar and footer: name => (chrome generation, html).
+_chrome = {}
+
 
 def render(template_name, data):
     filename = os.path.join(os.path.dirname(__file__), 'templates', template_name)
@@ -51,27 +56,54 @@ def render(template_name, data):
     return template.render(filename, data)
 
 
-def get_sidebar():
-    page_name = settings.get('sidebar', 'gaewiki:sidebar')
-    page = model.WikiContent.get_by_title(page_name)
-    if page.is_saved():
-        body = page.body
-    else:
-        body = u'<a href="/"><img src="/gae-wiki-static/logo-186.png" width="186" alt="logo" height="167"/></a>\n\nThis is a good place for a brief introduction to your wiki, a logo and such things.\n\n[Edit this text](/w/edit?page=%s)' % page_name
-    return body
+def render_fragment(template_name, data):
+    """Renders a part of a page that doesn't depend on the current user, so
+    the user, sidebar and footer aren't loaded."""
+    filename = os.path.join(os.path.dirname(__file__), 'templates', template_name)
+    if 'settings' not in data:
+        data['settings'] = settings.get_all()
+    return template.render(filename, data)
 
 
-def get_footer():
-    page_name = settings.get('footer', 'gaewiki:footer')
-    page = model.WikiContent.get_by_title(page_name)
-    if page.is_saved():
-        body = page.body
-    else:
-        body = u'This wiki is built with [GAEWiki](http://gaewiki.googlecode.com/).'
-    return body
+def get_chrome(name, load_body):
+    """Returns the rendered sidebar or footer.  The HTML is kept in process
+    memory and in memcache until the chrome cache generation is bumped,
+    which happens when the source page or the settings are saved."""
+    generation = cache.get_generations(['chrome'])['chrome']
+    cached = _chrome.get(name)
+    if cached is None or cached[0] != generation:
+        key = 'Chrome:%s:%u' % (name, generation)
+        html = memcache.get(key)
+        if html is None:
+            html = util.wikify_filter(load_body())
+            memcache.set(key, html)
+        cached = _chrome[name] = (generation, html)
+    return cached[1]
 
 
-def view_page(page, user=None, is_admin=False, revision=None):
+def get_sidebar():
+    def load_body():
+        page_name = settings.get('sidebar', 'gaewiki:sidebar')
+        page = model.WikiContent.get_by_title(page_name)
+        if page.is_saved():
+            return page.body
+        return u'<a href="/"><img src="/gae-wiki-static/logo-186.png" width="186" alt="logo" height="167"/></a>\n\nThis is a good place for a brief introduction to your wiki, a logo and such things.\n\n[Edit this text](/w/edit?page=%s)' % page_name
+    return get_chrome('sidebar', load_body)
+
+
+def get_footer():
+    def load_body():
+        page = model.WikiContent.get_by_title(settings.get('footer', 'gaewiki:footer'))
+        if page.is_saved():
+            return page.body
+        return u'This wiki is built with [GAEWiki](http://gaewiki.googlecode.com/).'
+    return get_chrome('footer', load_body)
+
+
+def view_page(page, user=None, is_admin=False, revision=None, cached_body=None):
+    """Renders a page.  The page body is rendered separately from the
+    personal parts (tabs, login links); cached_body can be a function that
+    returns the cached body, given a function that renders it."""
     page = page.get_redirected()
 
     if page.title.startswith("Label:") and not page.body:
@@ -80,12 +112,18 @@ def view_page(page, user=None, is_admin=False, revision=None):
     data = {
         'page': page,
         'is_admin': is_admin,
-        'is_plain': page.get_property('format') == 'plain',
         'can_edit': access.can_edit_page(page.title, user, is_admin),
-        'page_labels': page.get_property('labels', []),
         'revision': revision,
     }
 
+    if page.body:
+        def render_body():
+            return view_page_body(page)
+        if cached_body is not None:
+            data['body_html'] = cached_body(render_body)
+        else:
+            data['body_html'] = render_body()
+
     # logging.debug(data)
 
     if settings.get('enable-map'):
@@ -101,6 +139,15 @@ def view_page(page, user=None, is_admin=False, revision=None):
     return render('view_page.html', data)
 
 
+def view_page_body(page):
+    """Renders the part of the page that is the same for all users."""
+    return render_fragment('page_body.html', {
+        'page': page,
+        'is_plain': page.get_property('format') == 'plain',
+        'page_labels': page.get_property('labels', []),
+    })
+
+
 def edit_page(page, comment=None):
     logging.debug(u'Editing page "%s"' % page.title)
     return render('edit_page.html', {
@@ -109,7 +156,7 @@ def edit_page(page, comment=None):
     })
 
 
-def list_pages(pages):
+def list_pages(pages, next_url=None):
     logging.debug(u'Listing %u pages.' % len(pages))
     def link_line(title):
         return ('    ' * title.count('/')) + '- ' + ('[' + title + '](/' + title + ')' if ':' in title else '[[' + title + ']]')
@@ -127,22 +174,27 @@ def list_pages(pages):
         lines.append((title, link_line(title)))
     return render('index.html', {
         'pages': pages,
+        'next_url': next_url,
         'html': util.wikify(util.parse_markdown('\n'.join(line[1] for line in lines))),
     })
 
 
-def list_pages_feed(pages):
+def list_pages_feed(pages, next_url=None):
     logging.debug(u'Listing %u pages.' % len(pages))
+    model.WikiUser.prefetch(pages)
     return render('index.rss', {
         'pages': pages,
+        'next_url': next_url,
     })
 
 
-def show_page_history(page, user=None, is_admin=False):
+def show_page_history(page, revisions, next_url=None, user=None, is_admin=False):
+    model.WikiUser.prefetch([page] + revisions)
     return render('history.html', {
         'page_title': page.title,
         'page': page,
-        'revisions': page.get_history(),
+        'revisions': revisions,
+        'next_url': next_url,
         'can_edit': access.can_edit_page(page.title, user, is_admin),
     })
 
@@ -153,13 +205,16 @@ def get_sitemap(pages):
     })
 
 
-def get_change_list(pages):
+def get_change_list(pages, next_url=None):
+    model.WikiUser.prefetch(pages)
     return render('changes.html', {
         'pages': pages,
+        'next_url': next_url,
     })
 
 
 def get_change_feed(pages):
+    model.WikiUser.prefetch(pages)
     return render('changes.rss', {
         'pages': pages,
     })
@@ -178,8 +233,10 @@ def get_users(users):
     })
 
 
-def get_import_form():
-    return render('import.html', {})
+def get_import_form(submit_url):
+    return render('import.html', {
+        'submit_url': submit_url,
+    })
 
 
 def show_interwikis(iw):
@@ -210,8 +267,10 @@ def show_single_page_map(page):
     })
 
 
-def show_pages_map_data(pages):
-    """Returns the JavaScript with markers."""
+def get_map_data(pages):
+    """Returns the bounds and markers of the pages.  The marker HTML is
+    rendered when pages are saved; pages saved by older versions get it
+    rendered here."""
     data = {
         'bounds': {
             'minlat': 999,
@@ -222,29 +281,37 @@ def show_pages_map_data(pages):
         'markers': [],
         'length': len(pages),
     }
-
-    for page in pages:
-        lat = page.geopt.lat
-        lng = page.geopt.lon
-        if lat < data['bounds']['minlat']:
-            data['bounds']['minlat'] = lat
-        if lng < data['bounds']['minlng']:
-            data['bounds']['minlng'] = lng
-        if lat > data['bounds']['maxlat']:
-            data['bounds']['maxlat'] = lat
-        if lng > data['bounds']['maxlng']:
-            data['bounds']['maxlng'] = lng
-
+    if pages:
+        data['bounds'] = {
+            'minlat': min([p.geopt.lat for p in pages]),
+            'minlng': min([p.geopt.lon for p in pages]),
+            'maxlat': max([p.geopt.lat for p in pages]),
+            'maxlng': max([p.geopt.lon for p in pages]),
+        }
+    for page, html in zip(pages, model.PageHtml.get_map_html(pages)):
         data['markers'].append({
-            'lat': lat,
-            'lng': lng,
+            'lat': page.geopt.lat,
+            'lng': page.geopt.lon,
             'title': page.title,
-            'html': render('map_info_window.html', {'page': page}).decode('utf-8'),
+            'html': html,
         })
+    return data
+
 
+def show_pages_map_data(pages, more_url=None):
+    """Returns the JavaScript with markers.  With more_url, the map loads
+    markers of the visible area from it as it's moved, see
+    show_more_map_data()."""
+    data = get_map_data(pages)
+    data['more_url'] = more_url
     return 'var map_data = ' + simplejson.dumps(data) + ';'
 
 
+def show_more_map_data(pages):
+    """Returns the JavaScript that adds markers to the map."""
+    return 'add_map_data(' + simplejson.dumps(get_map_data(pages)) + ');'
+
+
 def view_image_upload_page(user, is_admin, submit_url):
     data = {
         "user": user,
@@ -263,42 +330,43 @@ def view_image(img, user, is_admin):
     return render("view_image.html", data)
 
 
-def view_image_list(lst, user, is_admin):
+def view_image_list(lst, user, is_admin, next_url=None):
     data = {
         "images": lst,
         "user": user,
         "is_admin": is_admin,
+        "next_url": next_url,
     }
     return render("image_list.html", data)
 
 
-def view_diff(r1, r2, user, is_admin):
-    a = r1.revision_body
-    if hasattr(r2, 'revision_body'):
-        b = r2.revision_body
+def get_diff_html(r1, r2):
+    """Returns the HTML diff between a revision and a later revision or the
+    current page.  Revisions never change, so diffs are cached by revision
+    keys; diffs against the page also by the page's update time."""
+    if isinstance(r2, model.WikiRevision):
+        key = 'Diff:%s:%s' % (r1.key(), r2.key())
     else:
-        b = r2.body
-    seqm = difflib.SequenceMatcher(None, a, b)
-    output = []
-    for opcode, a0, a1, b0, b1 in seqm.get_opcodes():
-        if opcode == 'equal':
-            output.append(seqm.a[a0:a1])
-        elif opcode == 'insert':
-            output.append("<ins>" + seqm.b[b0:b1] + "</ins>")
-        elif opcode == 'delete':
-            output.append("<del>" + seqm.a[a0:a1] + "</del>")
-        elif opcode == 'replace':
-            output.append("<del>" + seqm.a[a0:a1] + "</del>")
-            output.append("<ins>" + seqm.b[b0:b1] + "</ins>")
+        key = 'Diff:%s:%s:%s' % (r1.key(), r2.key(), r2.updated)
+    html = memcache.get(key)
+    if html is None:
+        if isinstance(r2, model.WikiRevision):
+            a, b = model.WikiRevision.get_bodies([r1, r2])
         else:
-            raise RuntimeError, "unexpected opcode"
+            a, b = r1.get_body(), r2.body
+        html = diff.get_html(a or u'', b or u'')
+        memcache.set(key, html)
+    return html
+
+
+def view_diff(r1, r2, user, is_admin):
     data = {
         "r1": r1,
         "r2": r2,
         "r1updated": r1.updated if hasattr(r1, 'updated') else r1.created,
         "r2updated": r2.updated if hasattr(r2, 'updated') else r2.created,
         "page_title": r2.title,
-        "diff_html": ''.join(output),
+        "diff_html": get_diff_html(r1, r2),
         "user": user,
         "is_admin": is_admin,
         'can_edit': access.can_edit_page(r2.title, user, is_admin),